@@ -6,7 +6,13 @@
 # Should update to include failed and incomplete sessions
 # that are associated with "published" mouse_ids"""
 
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from meso_tools.hash_utils import HashCache, hash_file_cached
 
 class NASapi():
     """NAStool interacts with the NAS storage device using http requests on the Synology API.
@@ -112,7 +118,7 @@ class NASapi():
         """
         response = requests.get("http://"+str(self.ip)+
         "/webapi/entry.cgi?api=SYNO.FileStation.List&version=2&method=list"+
-        "&additional=%5B%22real_path%22%2C%22size%2Cperm%22%5D&folder_path=%22%2F"+
+        "&additional=%5B%22real_path%22%2C%22size%22%2C%22perm%22%5D&folder_path=%22%2F"+
         folder+
         "%22&_sid="+self.sid, timeout = 5)
         return response.json()
@@ -143,7 +149,123 @@ class NASapi():
                 released_backups.append(folder['path'])
         return released_backups
 
-    def nas_delete(self, delete_item: str, delete: bool = True):
+    def nas_dir_size(self, path: str, poll_interval: float = 1.0, timeout: float = 600) -> int:
+        """Computes the total size of a NAS folder with a SYNO.FileStation.DirSize task.
+        The task is started, polled until the NAS reports it finished, and then stopped
+        to release it on the NAS side.
+
+        Parameters
+        ----------
+        path : str
+            NAS filepath of the folder, as returned by release_check
+        poll_interval : float
+            seconds to wait between status requests, 1 by default
+        timeout : float
+            seconds to wait for the task to finish before giving up, 600 by default
+
+        Returns
+        -------
+        int
+            total size of the folder in bytes
+        """
+        response = requests.get("http://"+self.ip+
+        "/webapi/entry.cgi?api=SYNO.FileStation.DirSize&version=2&method=start&path=%22%2F"+
+        str(path.lstrip('/'))+"%22&_sid="+self.sid, timeout = 5)
+        task_id = response.json()['data']['taskid']
+        start = time.time()
+        try:
+            while True:
+                response = requests.get("http://"+self.ip+
+                "/webapi/entry.cgi?api=SYNO.FileStation.DirSize&version=2&method=status&taskid=%22"+
+                str(task_id)+"%22&_sid="+self.sid, timeout = 5)
+                status = response.json()['data']
+                if status['finished']:
+                    return int(status['total_size'])
+                if time.time() - start > timeout:
+                    raise TimeoutError(f"Size of {path} was not computed in {timeout} s")
+                time.sleep(poll_interval)
+        finally:
+            requests.get("http://"+self.ip+
+            "/webapi/entry.cgi?api=SYNO.FileStation.DirSize&version=2&method=stop&taskid=%22"+
+            str(task_id)+"%22&_sid="+self.sid, timeout = 5)
+
+    def nas_plan_cleanup(self, sessions: list, folders: list = None, max_workers: int = 8) -> dict:
+        """Builds a dry-run cleanup plan: the folders of released sessions on this NAS
+        and the number of bytes that deleting them will reclaim, per share.
+        Each share is listed once, folder sizes are computed with DirSize tasks
+        running concurrently, so the shares are not walked a second time.
+
+        Parameters
+        ----------
+        sessions : list
+            List of released ophys session IDs, as strings
+        folders : list
+            NAS folders to check, by default the known backup folders from nas_folders
+        max_workers : int
+            number of DirSize tasks to run at the same time, 8 by default
+
+        Returns
+        -------
+        dict
+            machine-readable plan that can be saved with save_cleanup_plan
+            and executed with nas_execute_plan
+        """
+        if folders is None:
+            folders = self.nas_folders()
+        plan = {'hostname': self.hostname,
+                'ip': self.ip,
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'shares': {},
+                'total_bytes': 0}
+        to_size = []
+        for folder in folders:
+            share = {'paths': [], 'bytes': 0}
+            for item in self.nas_query(folder)['data']['files']:
+                if item['name'] not in sessions:
+                    continue
+                entry = {'path': item['path'], 'name': item['name'], 'bytes': 0}
+                if item.get('isdir', True):
+                    to_size.append(entry)
+                else:
+                    entry['bytes'] = int(item['additional']['size'])
+                share['paths'].append(entry)
+            plan['shares'][folder] = share
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            sizes = executor.map(self.nas_dir_size, [entry['path'] for entry in to_size])
+            for entry, size in zip(to_size, sizes):
+                entry['bytes'] = size
+
+        for share in plan['shares'].values():
+            share['bytes'] = sum(entry['bytes'] for entry in share['paths'])
+            plan['total_bytes'] += share['bytes']
+        return plan
+
+    def nas_execute_plan(self, plan: dict, delete: bool = True) -> list:
+        """Deletes every folder listed in a cleanup plan made by nas_plan_cleanup
+
+        Parameters
+        ----------
+        plan : dict
+            cleanup plan, made for the NAS this instance is logged into
+        delete: bool, True by default
+            Determines wether the call to this function will actually delete
+
+        Returns
+        -------
+        list
+            NAS filepaths that were submitted for deletion
+        """
+        assert plan['hostname'] == self.hostname, \
+            f"Plan was made for {plan['hostname']}, logged into {self.hostname}"
+        submitted = []
+        for share in plan['shares'].values():
+            for entry in share['paths']:
+                self.nas_delete(entry['path'], delete=delete)
+                submitted.append(entry['path'])
+        return submitted
+
+    def nas_delete(self, delete_item: str, delete: bool = True) -> str:
         """Deletes NAS folders from a list of filepaths
 
         Parameters
@@ -153,6 +275,11 @@ class NASapi():
             calculated in the release check function
         delete: bool, True by default
             Determines wether the call to this function will actually delete
+
+        Returns
+        -------
+        str
+            task ID of the deletion job, None if nothing was deleted
         """
         print('deleting '+str(delete_item))
         if delete is True:
@@ -164,6 +291,8 @@ class NASapi():
             task_id = response.json()['data']['taskid']
             #store task ID's for later in case we need to stop a job
             self.task_id = task_id
+            return task_id
+        return None
 
     def nas_stop(self):
         """Stop deleting jobs.  Only stops the most recent call to nas_delete.
@@ -173,22 +302,55 @@ class NASapi():
         "/webapi/entry.cgi?api=SYNO.FileStation.Delete&version=2&method=stop&taskid=%22"+
         str(task_id)+"%22&_sid="+self.sid, timeout = 5)
 
-    def nas_status(self) -> dict:
+    def nas_status(self, task_id: str = None) -> dict:
         """Check status of current deletion job
 
+        Parameters
+        ----------
+        task_id : str
+            task ID returned by nas_delete, by default the most recent deletion job
+
         Returns
         -------
         list
             returns dictionary containig the response of the deletion status query
         """
-
-        task_id = self.task_id
+        if task_id is None:
+            task_id = self.task_id
         response = requests.get("http://"+self.ip+
         "/webapi/entry.cgi?api=SYNO.FileStation.Delete&version=2&method=status&taskid=%22"+
         str(task_id)+"%22&_sid="+self.sid, timeout = 5)
 
         return response
 
+    def nas_wait(self, task_id: str, poll_interval: float = 5.0, timeout: float = 3600) -> bool:
+        """Wait for a deletion job to finish
+
+        Parameters
+        ----------
+        task_id : str
+            task ID returned by nas_delete
+        poll_interval : float
+            seconds to wait between status requests, 5 by default
+        timeout : float
+            seconds to wait for the job to finish before giving up, 3600 by default
+
+        Returns
+        -------
+        bool
+            True if the job finished, False if the NAS does not know the task
+            (for example after the NAS or the session was restarted)
+        """
+        start = time.time()
+        while True:
+            status = self.nas_status(task_id).json()
+            if not status.get('success', False):
+                return False
+            if status['data']['finished']:
+                return True
+            if time.time() - start > timeout:
+                raise TimeoutError(f"Deletion job {task_id} did not finish in {timeout} s")
+            time.sleep(poll_interval)
 
     def nas_logout(self):
         """Log out of the connection to NAS server
@@ -197,3 +359,318 @@ class NASapi():
         "/webapi/auth.cgi?api=SYNO.API.Auth&version=6&method=logout&session=FileStation",
          timeout = 5)
         print('session '+ self.sid+' logged out')
+
+
+def save_cleanup_plan(plan: dict, path: str) -> None:
+    """Writes a cleanup plan made by NASapi.nas_plan_cleanup to a json file
+
+    Parameters
+    ----------
+    plan : dict
+        cleanup plan
+    path : str
+        path to the json file to write
+    """
+    with open(path, 'w', encoding='UTF-8') as plan_file:
+        json.dump(plan, plan_file, indent=2)
+
+
+def load_cleanup_plan(path: str) -> dict:
+    """Reads a cleanup plan written by save_cleanup_plan
+
+    Parameters
+    ----------
+    path : str
+        path to the json file with the plan
+
+    Returns
+    -------
+    dict
+        cleanup plan
+    """
+    with open(path, encoding='UTF-8') as plan_file:
+        return json.load(plan_file)
+
+
+class CleanupJournal():
+    """Persistent record of a NAS cleanup run. Every NAS path goes through the states
+    planned -> submitted -> completed, the journal is written to disk after each change,
+    so a restarted run can skip the work that is already done.
+    Safe to share between threads working on different NAS devices.
+    """
+    PLANNED = 'planned'
+    SUBMITTED = 'submitted'
+    COMPLETED = 'completed'
+
+    def __init__(self, journal_path: str):
+        """Loads the journal from journal_path, or starts an empty one if the file does not exist
+
+        Parameters
+        ----------
+        journal_path : str
+            path to the json file holding the journal
+        """
+        self.journal_path = journal_path
+        self._lock = threading.Lock()
+        if os.path.isfile(journal_path):
+            with open(journal_path, encoding='UTF-8') as journal_file:
+                self.journal = json.load(journal_file)
+        else:
+            self.journal = {'hosts': {}, 'paths': {}}
+
+    def _save(self):
+        # write to a temporary file first so a crash never leaves a truncated journal
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'w', encoding='UTF-8') as journal_file:
+            json.dump(self.journal, journal_file, indent=2)
+        os.replace(tmp_path, self.journal_path)
+
+    def is_planned(self, hostname: str) -> bool:
+        """True if the paths to delete on hostname are already recorded"""
+        with self._lock:
+            return self.journal['hosts'].get(hostname, False)
+
+    def add_plan(self, hostname: str, paths: list):
+        """Records the NAS paths to delete on hostname, all in planned state"""
+        with self._lock:
+            for path in paths:
+                key = hostname + ':' + path
+                if key not in self.journal['paths']:
+                    self.journal['paths'][key] = {'hostname': hostname, 'path': path,
+                                                  'state': self.PLANNED, 'task_id': None}
+            self.journal['hosts'][hostname] = True
+            self._save()
+
+    def entries(self, hostname: str) -> list:
+        """All journal entries for hostname"""
+        with self._lock:
+            return [dict(entry) for entry in self.journal['paths'].values()
+                    if entry['hostname'] == hostname]
+
+    def set_state(self, hostname: str, path: str, state: str, task_id: str = None):
+        """Moves the entry for path on hostname to a new state"""
+        with self._lock:
+            entry = self.journal['paths'][hostname + ':' + path]
+            entry['state'] = state
+            entry['task_id'] = task_id
+            self._save()
+
+
+def _plan_paths(plan: dict) -> list:
+    """NAS paths listed in a cleanup plan made by NASapi.nas_plan_cleanup"""
+    return [entry['path'] for share in plan['shares'].values() for entry in share['paths']]
+
+
+def _wait_deletion(api: NASapi, task_id: str, poll_interval: float, timeout: float) -> bool:
+    """Waits for a deletion job like NASapi.nas_wait, but returns False instead of raising on timeout"""
+    try:
+        return api.nas_wait(task_id, poll_interval, timeout)
+    except TimeoutError as error:
+        print(f'warning: {api.hostname}: {error}')
+        return False
+
+
+def _run_device_cleanup(api: NASapi, sessions: list, journal: CleanupJournal, delete: bool,
+                        poll_interval: float, plan: dict = None, timeout: float = 3600) -> dict:
+    """Seeds the journal from plan (or a new nas_plan_cleanup plan) unless the device is already
+    in the journal, and runs the cleanup on one NAS device, returns numbers of paths completed in this run
+    and of paths left unfinished (still submitted, to be resumed by the next run).
+    A dry run (delete=False) only prints what would be deleted and does not write the journal."""
+    if not journal.is_planned(api.hostname):
+        if plan is None:
+            plan = api.nas_plan_cleanup(sessions)
+        assert plan['hostname'] == api.hostname, \
+            f"Plan was made for {plan['hostname']}, logged into {api.hostname}"
+        if not delete:
+            for path in _plan_paths(plan):
+                api.nas_delete(path, delete=False)
+            return {'completed': 0, 'unfinished': 0}
+        journal.add_plan(api.hostname, _plan_paths(plan))
+
+    completed = 0
+    unfinished = 0
+    for entry in journal.entries(api.hostname):
+        if entry['state'] == CleanupJournal.COMPLETED:
+            continue
+        # a job submitted before a restart is only trusted if the NAS still knows about it
+        if delete and entry['state'] == CleanupJournal.SUBMITTED and _wait_deletion(api, entry['task_id'], poll_interval, timeout):
+            journal.set_state(api.hostname, entry['path'], CleanupJournal.COMPLETED, entry['task_id'])
+            completed += 1
+            continue
+        task_id = api.nas_delete(entry['path'], delete=delete)
+        if not delete:
+            continue
+        journal.set_state(api.hostname, entry['path'], CleanupJournal.SUBMITTED, task_id)
+        if _wait_deletion(api, task_id, poll_interval, timeout):
+            journal.set_state(api.hostname, entry['path'], CleanupJournal.COMPLETED, task_id)
+            completed += 1
+        else:
+            # left submitted, the next run waits for it again or resubmits it
+            print(f'warning: {api.hostname}: deletion of {entry["path"]} (task {task_id}) did not finish')
+            unfinished += 1
+    if unfinished:
+        print(f'warning: {api.hostname}: {unfinished} deletions unfinished, re-run with the same journal to resume')
+    return {'completed': completed, 'unfinished': unfinished}
+
+
+def run_cleanup(apis: list, sessions: list, journal_path: str, delete: bool = True,
+                poll_interval: float = 5.0, plans: list = None, timeout: float = 3600) -> dict:
+    """Deletes backups of released sessions on several NAS devices at the same time,
+    keeping a journal so that a restarted run skips completed work and does not re-query the NAS.
+    Devices not yet in the journal are seeded from their plan in plans (for example the reviewed
+    dry-run plans written by save_cleanup_plan), or from a new nas_plan_cleanup plan.
+
+    Parameters
+    ----------
+    apis : list
+        logged in NASapi instances, one per device
+    sessions : list
+        List of released ophys session IDs, as strings, used for devices without a plan
+    journal_path : str
+        path to the json journal, created if it does not exist
+    delete : bool, True by default
+        Determines wether the run will actually delete, a dry run leaves the journal untouched
+    poll_interval : float
+        seconds to wait between deletion status requests, 5 by default
+    plans : list, optional
+        cleanup plans (dicts or paths to json files from save_cleanup_plan), matched to devices by hostname
+    timeout : float
+        seconds to wait for one deletion job, 3600 by default
+
+    Returns
+    -------
+    dict
+        per NAS hostname, a dict with the number of paths completed in this run ('completed')
+        and of deletions that did not finish or timed out ('unfinished'); unfinished paths stay
+        submitted in the journal and are resumed by re-running with the same journal_path
+    """
+    journal = CleanupJournal(journal_path)
+    plans_by_host = {}
+    for plan in plans or []:
+        if isinstance(plan, str):
+            plan = load_cleanup_plan(plan)
+        plans_by_host[plan['hostname']] = plan
+    with ThreadPoolExecutor(max_workers=len(apis)) as executor:
+        futures = {api.hostname: executor.submit(_run_device_cleanup, api, sessions, journal, delete,
+                                                 poll_interval, plans_by_host.get(api.hostname), timeout)
+                   for api in apis}
+        return {hostname: future.result() for hostname, future in futures.items()}
+
+
+def hash_directory(directory: str, algorithm: str = 'blake2b', cache: HashCache = None,
+                   max_workers: int = 8, save_every: int = 100, save_interval: float = 300) -> dict:
+    """Hashes every file under directory with a pool of threads, using cache when given.
+    The cache is saved every save_every newly hashed files or save_interval seconds, and when hashing
+    stops (also on errors), so an interrupted run keeps the digests computed so far.
+
+    Parameters
+    ----------
+    directory : str
+        local or primary storage folder of a session
+    algorithm : str
+        'blake2b' by default, 'xxh3_128' if xxhash is installed, or any hashlib algorithm
+    cache : HashCache, optional
+        cache of previously computed hashes, updated with the new ones
+    max_workers : int
+        number of files hashed at the same time, 8 by default
+    save_every : int
+        number of newly hashed files between cache saves, 100 by default
+    save_interval : float
+        seconds between cache saves, 300 by default
+
+    Returns
+    -------
+    dict
+        hex digest for each file, keyed by path relative to directory (with '/' separators)
+    """
+    files = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            files.append(os.path.join(root, name))
+
+    saved_at = [time.time()]
+
+    def _hash(path):
+        digest = hash_file_cached(path, cache, algorithm)
+        if cache is not None and cache.unsaved and (cache.unsaved >= save_every
+                                                    or time.time() - saved_at[0] >= save_interval):
+            saved_at[0] = time.time()
+            cache.save()
+        return digest
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            digests = list(executor.map(_hash, files))
+    finally:
+        if cache is not None:
+            cache.save()
+    return {os.path.relpath(path, directory).replace(os.sep, '/'): digest
+            for path, digest in zip(files, digests)}
+
+
+def write_manifest(directory: str, manifest_path: str, algorithm: str = 'blake2b',
+                   cache: HashCache = None, max_workers: int = 8) -> dict:
+    """Hashes a session folder and writes the manifest to a json file
+
+    Parameters
+    ----------
+    directory : str
+        session folder to describe
+    manifest_path : str
+        path to the json manifest to write
+    algorithm : str
+        'blake2b' by default, 'xxh3_128' if xxhash is installed, or any hashlib algorithm
+    cache : HashCache, optional
+        cache of previously computed hashes
+    max_workers : int
+        number of files hashed at the same time, 8 by default
+
+    Returns
+    -------
+    dict
+        manifest, with the algorithm and the digest of each file
+    """
+    manifest = {'algorithm': algorithm,
+                'files': hash_directory(directory, algorithm, cache, max_workers)}
+    with open(manifest_path, 'w', encoding='UTF-8') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    return manifest
+
+
+def verify_manifest(directory: str, manifest: dict, cache: HashCache = None,
+                    max_workers: int = 8) -> dict:
+    """Checks that a session folder matches a manifest, before its backup is deleted from NAS
+
+    Parameters
+    ----------
+    directory : str
+        local or primary storage folder of the session
+    manifest : dict
+        manifest made by write_manifest, or path to its json file
+    cache : HashCache, optional
+        cache of previously computed hashes, files with unchanged size and mtime are not rehashed
+    max_workers : int
+        number of files hashed at the same time, 8 by default
+
+    Returns
+    -------
+    dict
+        lists of relative paths: 'matched', 'mismatched', 'missing' (in manifest, not in directory)
+        and 'extra' (in directory, not in manifest), and 'verified', True if nothing differs
+    """
+    if isinstance(manifest, str):
+        with open(manifest, encoding='UTF-8') as manifest_file:
+            manifest = json.load(manifest_file)
+    digests = hash_directory(directory, manifest['algorithm'], cache, max_workers)
+    expected = manifest['files']
+    result = {'matched': [], 'mismatched': [], 'missing': [],
+              'extra': sorted(set(digests) - set(expected))}
+    for path, digest in expected.items():
+        if path not in digests:
+            result['missing'].append(path)
+        elif digests[path] == digest:
+            result['matched'].append(path)
+        else:
+            result['mismatched'].append(path)
+    result['verified'] = not (result['mismatched'] or result['missing'])
+    return result
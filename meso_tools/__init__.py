@@ -13,22 +13,45 @@ from . io_utils import read_scanimage_stack_metadata as read_scanimage_stack_met
 from . io_utils import read_scanimage_metadata as read_scanimage_metadata
 from . io_utils import read_plane_in_stack as read_plane_in_stack
 from . io_utils import append_suffix_to_filename as append_suffix_to_filename
+from . io_utils import get_num_frames as get_num_frames
+from . io_utils import read_frames as read_frames
+from . io_utils import iter_chunks as iter_chunks
+from . io_utils import StackWriter as StackWriter
 
 from . conversion_utils import to_16bit as to_16bit
+from . conversion_utils import to_8bit as to_8bit
+from . conversion_utils import compute_scaling as compute_scaling
+from . conversion_utils import convert_chunks as convert_chunks
+from . conversion_utils import convert_movie as convert_movie
 
 from . image_tools import get_pixel_hist2d as get_pixel_hist2d
+from . image_tools import PixelHist2D as PixelHist2D
+from . image_tools import get_pixel_hist2d_chunks as get_pixel_hist2d_chunks
 from . image_tools import image_plot as image_plot
 from . image_tools import plot_all_colormaps as plot_all_colormaps
 from . image_tools import average_intensity as average_intensity
 from . image_tools import align_phase as align_phase
+from . image_tools import estimate_phase_offsets as estimate_phase_offsets
 from . image_tools import align_phase_stack as align_phase_stack
+from . image_tools import apply_phase_offset as apply_phase_offset
+from . image_tools import align_phase_movie as align_phase_movie
+from . image_tools import combine_phase_offsets as combine_phase_offsets
+from . image_tools import PhaseOffsetRegistry as PhaseOffsetRegistry
 from . image_tools import average_n as average_n
+from . image_tools import bin_chunks as bin_chunks
+from . image_tools import bin_movie as bin_movie
 from . image_tools import compute_acutance as compute_acutance
 from . image_tools import offset_to_zero as offset_to_zero
 from . image_tools import image_downsample as image_downsample
 from . image_tools import image_negative_rescale as image_negative_rescale
+from . image_tools import rescale_intensity as rescale_intensity
 from . image_tools import compute_contrast as compute_contrast
+from . image_tools import IntensityHistogram as IntensityHistogram
+from . image_tools import compute_histogram_stats as compute_histogram_stats
 from . image_tools import compute_basic_snr as compute_basic_snr
 from . image_tools import compute_photon_flux as compute_photon_flux
 from . image_tools import compute_block_snr as compute_block_snr
-from . image_tools import compute_temporal_variance as compute_temporal_variance
\ No newline at end of file
+from . image_tools import compute_block_metrics as compute_block_metrics
+from . image_tools import compute_temporal_variance as compute_temporal_variance
+from . image_tools import TemporalStats as TemporalStats
+from . image_tools import compute_temporal_stats as compute_temporal_stats
\ No newline at end of file
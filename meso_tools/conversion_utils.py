@@ -1,6 +1,8 @@
 ## this file has finctions to convert data
 
 import numpy as np
+from meso_tools.io_utils import get_num_frames, read_frames, iter_chunks, StackWriter
+from meso_tools.image_tools import IntensityHistogram
 
 def to_16bit(data, keep_dtype=True):
 	"""
@@ -17,11 +19,11 @@ def to_16bit(data, keep_dtype=True):
 	# let's first take care of the negative values 
 	data_min = np.min(data)
 	if data_min < 0:
-		data -= data_min
+		data = data - data_min # new array, input is not modified
 	data_max = np.max(data)
 
 	#let's check is teh 16bit dynamic range can be saturated 
-	if data_max > 65355 :
+	if data_max > 65535 :
 		raise ValueError('Cancelling. Data needs to eb re-scaled first to avoid higher values truncation.')
 	else:
 		if keep_dtype:
@@ -37,19 +39,103 @@ def to_8bit(data, keep_dtype=True):
 	"""
 	this function will convert data to 8 bit
 	if keep_dtype is True, input data type will be preserved: 
-		floatN -> float8
-		intN -> int8
-	if keep_dtype is False, output data is always int16
-		floatN -> int8
-		intN -> int8
+		floatN -> float16 (smallest float numpy has)
+		intN -> uint8
+	if keep_dtype is False, output data is always uint8
+		floatN -> uint8
+		intN -> uint8
+	integer values outside [0, 255] are clipped, to scale data first use convert_chunks
 	Return: converted numpy array
 	"""
-	if keep_dtype:
-		if data.dtype == np.int16 :
-			data_out = data.astype(np.uint16)
-		else:
-			data_out = data.astype(np.float16) #assuming float in all other cases
+	if keep_dtype and not np.issubdtype(data.dtype, np.integer):
+		data_out = data.astype(np.float16)
 	else: 
-		data_out = data.astype(np.uint16)
+		data_out = np.clip(data, 0, 255).astype(np.uint8)
+
+	return data_out
+
+def _chunk_factory(source, chunk_size, field):
+	"""
+	returns a function that gives a new chunk iterator over source on every call:
+	source can be a path to tiff/hdf5 movie, an array (or memmap), or an iterable of chunks 
+	(a one-shot iterator can only be read once)
+	"""
+	if isinstance(source, str):
+		return lambda: iter_chunks(source, chunk_size, field)
+	if isinstance(source, np.ndarray):
+		return lambda: (source[start:start+chunk_size] for start in range(0, len(source), chunk_size))
+	return lambda: iter(source)
+
+def compute_scaling(source, window='linear', percentiles=(1, 99.9), value_range=None, bins=65536, chunk_size=500, field='data'):
+	"""
+	this function will compute the intensity window [low, high] to convert data with, 
+	streaming through it in chunks:
+		window='linear' : low and high are global min and max, one pass
+		window='percentile' : low and high are global percentiles, one pass for 8/16 bit integer data
+			(exact, intensity histogram), for float data and wider integers the histogram has `bins` bins over value_range - 
+			if it's not given, a first pass finds min and max, so source has to be re-readable (path or array)
+	source: path to tiff/hdf5 movie, array/memmap, or iterable of chunks
+	Return: (low, high)
+	"""
+	chunks = _chunk_factory(source, chunk_size, field)
+	if window == 'linear':
+		low, high = np.inf, -np.inf
+		for chunk in chunks():
+			low = min(low, float(chunk.min()))
+			high = max(high, float(chunk.max()))
+		return low, high
+	if window != 'percentile':
+		raise ValueError(f"Unknown window {window}, has to be 'linear' or 'percentile'")
+
+	histogram = None
+	iterator = chunks()
+	first_chunk = next(iterator)
+	if np.issubdtype(first_chunk.dtype, np.integer) and np.iinfo(first_chunk.dtype).bits <= 16 and value_range is None:
+		histogram = IntensityHistogram(first_chunk.dtype)
+	else:
+		if value_range is None:
+			value_range = compute_scaling(source, 'linear', chunk_size=chunk_size, field=field)
+			iterator = chunks()
+			first_chunk = next(iterator)
+		histogram = IntensityHistogram(first_chunk.dtype, value_range, bins)
+	histogram.update(first_chunk)
+	for chunk in iterator:
+		histogram.update(chunk)
+	low, high = histogram.percentile(list(percentiles))
+	return float(low), float(high)
 
-	return data_out
\ No newline at end of file
+def convert_chunks(chunks, low, high, dtype=np.uint8):
+	"""
+	this function will convert chunks of data to an integer dtype, linearly mapping [low, high] 
+	to the full output range and clipping (saturating) values outside of it.
+	Chunks are not modified, every chunk is scaled in a float32 temporary of its size.
+	Return: generator of converted chunks
+	"""
+	dtype = np.dtype(dtype)
+	out_max = np.iinfo(dtype).max
+	scale = out_max / (high - low) if high > low else 0.0
+	for chunk in chunks:
+		scaled = np.subtract(chunk, low, dtype=np.float32)
+		np.multiply(scaled, scale, out=scaled)
+		np.clip(scaled, 0, out_max, out=scaled)
+		np.rint(scaled, out=scaled)
+		yield scaled.astype(dtype)
+
+def convert_movie(source, destination, dtype=np.uint8, window='linear', percentiles=(1, 99.9), value_range=None, chunk_size=500, field='data'):
+	"""
+	this function will convert a movie (e.g. 32 bit processed movie) to uint8 or uint16 for archive or display
+	without loading it: first pass computes the intensity window (see compute_scaling), 
+	second pass writes clipped and scaled chunks to destination (hdf5 if extension is .h5/.hdf5, bigtiff otherwise)
+	source: path to tiff/hdf5 movie or array/memmap
+	Return: (low, high) window that was used
+	"""
+	chunks = _chunk_factory(source, chunk_size, field)
+	low, high = compute_scaling(source, window, percentiles, value_range, chunk_size=chunk_size, field=field)
+	if isinstance(source, str):
+		shape = (get_num_frames(source, field),) + read_frames(source, 0, 1, field).shape[1:]
+	else:
+		shape = source.shape
+	with StackWriter(destination, shape, dtype, field) as writer:
+		for converted in convert_chunks(chunks(), low, high, dtype):
+			writer.write(converted)
+	return low, high
@@ -0,0 +1,128 @@
+## this file has functions to hash files:
+### buffered file hashing and a persistent cache of hashes, used by NAS cleanup and batch stitching
+
+import hashlib
+import json
+import os
+import threading
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+HASH_BUFFER_SIZE = 16 * 2**20  # bytes read per call when hashing files
+
+
+def _new_hasher(algorithm: str):
+    """Returns a new hash object for algorithm, 'xxh3_128' (needs xxhash) or any hashlib name"""
+    if algorithm == 'xxh3_128':
+        assert xxhash is not None, "xxhash is not installed, use algorithm='blake2b'"
+        return xxhash.xxh3_128()
+    return hashlib.new(algorithm)
+
+
+def hash_file(path: str, algorithm: str = 'blake2b', buffer_size: int = HASH_BUFFER_SIZE) -> str:
+    """Hashes a file, reading it in large blocks into one reused buffer.
+    hashlib and xxhash release the GIL while hashing, so several files can be hashed in threads.
+
+    Parameters
+    ----------
+    path : str
+        path to the file
+    algorithm : str
+        'blake2b' by default, 'xxh3_128' if xxhash is installed, or any hashlib algorithm
+    buffer_size : int
+        number of bytes read at once, 16 MB by default
+
+    Returns
+    -------
+    str
+        hex digest of the file content
+    """
+    hasher = _new_hasher(algorithm)
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as data_file:
+        while True:
+            num_read = data_file.readinto(buffer)
+            if not num_read:
+                break
+            hasher.update(view[:num_read])
+    return hasher.hexdigest()
+
+
+class HashCache():
+    """Persistent cache of file hashes keyed by (path, size, mtime),
+    so files that did not change since the last cleanup cycle are never hashed again.
+    """
+    def __init__(self, cache_path: str):
+        """Loads the cache from cache_path, or starts an empty one if the file does not exist
+
+        Parameters
+        ----------
+        cache_path : str
+            path to the json file holding the cache
+        """
+        self.cache_path = cache_path
+        self.unsaved = 0  # digests put since the last save
+        self._lock = threading.Lock()
+        if os.path.isfile(cache_path):
+            with open(cache_path, encoding='UTF-8') as cache_file:
+                self.cache = json.load(cache_file)
+        else:
+            self.cache = {}
+
+    def get(self, path: str, stat: os.stat_result, algorithm: str) -> str:
+        """Cached digest of path, None if the file changed or was never hashed with algorithm"""
+        with self._lock:
+            entry = self.cache.get(os.path.abspath(path))
+        if (entry is None or entry['size'] != stat.st_size
+                or entry['mtime'] != stat.st_mtime_ns or algorithm not in entry['digests']):
+            return None
+        return entry['digests'][algorithm]
+
+    def put(self, path: str, stat: os.stat_result, algorithm: str, digest: str):
+        """Stores digest of path for its current size and mtime"""
+        key = os.path.abspath(path)
+        with self._lock:
+            entry = self.cache.get(key)
+            if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+                entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'digests': {}}
+                self.cache[key] = entry
+            entry['digests'][algorithm] = digest
+            self.unsaved += 1
+
+    def save(self):
+        """Writes the cache to disk"""
+        with self._lock:
+            tmp_path = self.cache_path + '.tmp'
+            with open(tmp_path, 'w', encoding='UTF-8') as cache_file:
+                json.dump(self.cache, cache_file)
+            os.replace(tmp_path, self.cache_path)
+            self.unsaved = 0
+
+
+def hash_file_cached(path: str, cache: HashCache = None, algorithm: str = 'blake2b') -> str:
+    """Hashes a file, unless cache has its digest for the file's current size and mtime
+
+    Parameters
+    ----------
+    path : str
+        path to the file
+    cache : HashCache, optional
+        cache of previously computed hashes, updated with the new one (not saved)
+    algorithm : str
+        'blake2b' by default, 'xxh3_128' if xxhash is installed, or any hashlib algorithm
+
+    Returns
+    -------
+    str
+        hex digest of the file content
+    """
+    stat = os.stat(path)
+    digest = cache.get(path, stat, algorithm) if cache is not None else None
+    if digest is None:
+        digest = hash_file(path, algorithm)
+        if cache is not None:
+            cache.put(path, stat, algorithm, digest)
+    return digest
@@ -1,16 +1,22 @@
 ## this file definse functions to manipulate pixel data:
 ### plot histograms, adjsut contrast, measure SNR, etc
 
-from typing import Tuple, Union
+from typing import Iterable, Iterator, Tuple, Union
+from collections import deque
+from itertools import zip_longest
+from concurrent.futures import ThreadPoolExecutor
 import glob
+import json
+import os
 import numpy as np
+import pandas as pd
 import scipy.stats
 import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm
 from skimage import io
 from skimage.transform import resize
 from skimage.util import view_as_blocks
-import tifffile as tiff
+from meso_tools.io_utils import get_num_frames, read_frames, iter_chunks, StackWriter
 
 CMAPS = ['Accent', 'Accent_r', 'Blues', 'Blues_r', 'BrBG', 'BrBG_r', 'BuGn', 'BuGn_r', 'BuPu', 'BuPu_r',
                  'CMRmap', 'CMRmap_r', 'Dark2', 'Dark2_r', 'GnBu', 'GnBu_r', 'Greens', 'Greens_r', 'Greys',
@@ -68,12 +74,180 @@ def get_pixel_hist2d(vector_1 : np.array, vector_2 : np.array, bins : int, fig_s
     slope, offset, r_value, _, _ = scipy.stats.linregress(vector_1, vector_2)
     fit_fn = np.poly1d([slope, offset])
 
-    plt.plot(vector_1, fit_fn(vector_1), '--k')
+    # a straight line only needs its end points
+    plt.plot(xedges[[0, -1]], fit_fn(xedges[[0, -1]]), '--k')
     plt.xlabel(xlabel)
     plt.ylabel(ylabel)
     plt.title(f"{fit_fn}, R2={np.around(r_value**2, decimals=2)}")
     return fig, slope, offset, r_value
 
+class PixelHist2D():
+    """
+    2D histogram of pixel pairs with fixed bins plus the statistics of a linear fit, 
+    accumulated over chunks of two paired movies, so whole sessions never have to be in memory.
+    Fit statistics are kept as count, means and centered sums of squares and cross-products 
+    (equivalent to sums of x, y, xy, x^2, y^2, but merged without loss of precision, Chan et al.).
+    """
+    def __init__(self, bins : int, value_range : Tuple[Tuple[float, float], Tuple[float, float]]):
+        """
+        Parameters
+        ----------
+        bins : int
+            number of bins along each axis
+        value_range : Tuple[Tuple[float, float], Tuple[float, float]]
+            ((x min, x max), (y min, y max)) covered by the bins, values outside are not counted in histogram 
+            (they are still used for the fit)
+        """
+        self.xedges = np.linspace(value_range[0][0], value_range[0][1], bins+1)
+        self.yedges = np.linspace(value_range[1][0], value_range[1][1], bins+1)
+        self.hist = np.zeros((bins, bins), dtype=np.int64)
+        self.n = 0
+        self.mean_x = 0.0
+        self.mean_y = 0.0
+        self.sxx = 0.0
+        self.syy = 0.0
+        self.sxy = 0.0
+
+    def update(self, vector_1 : np.array, vector_2 : np.array) -> 'PixelHist2D':
+        """
+        Add pairs of pixels (arrays of any, but the same, shape, e.g. chunks of two paired planes)
+
+        Parameters
+        ----------
+        vector_1 : np.array
+            data 1 (x)
+        vector_2 : np.array
+            data 2 (y)
+
+        Returns
+        -------
+        PixelHist2D
+            self, updated
+        """
+        x = np.asarray(vector_1, dtype=np.float64).ravel()
+        y = np.asarray(vector_2, dtype=np.float64).ravel()
+        hist, _, _ = np.histogram2d(x, y, bins=[self.xedges, self.yedges])
+        chunk = PixelHist2D.__new__(PixelHist2D)
+        chunk.hist = hist.astype(np.int64)
+        chunk.n = len(x)
+        chunk.mean_x = x.mean()
+        chunk.mean_y = y.mean()
+        dx = x - chunk.mean_x
+        dy = y - chunk.mean_y
+        chunk.sxx = np.dot(dx, dx)
+        chunk.syy = np.dot(dy, dy)
+        chunk.sxy = np.dot(dx, dy)
+        return self.merge(chunk)
+
+    def merge(self, other : 'PixelHist2D') -> 'PixelHist2D':
+        """
+        Add histogram and fit statistics of other pixel pairs, with the same bins
+
+        Parameters
+        ----------
+        other : PixelHist2D
+            accumulated other pairs
+
+        Returns
+        -------
+        PixelHist2D
+            self, updated
+        """
+        if other.n == 0:
+            return self
+        n = self.n + other.n
+        dx = other.mean_x - self.mean_x
+        dy = other.mean_y - self.mean_y
+        weight = self.n * other.n / n
+        self.sxx += other.sxx + dx * dx * weight
+        self.syy += other.syy + dy * dy * weight
+        self.sxy += other.sxy + dx * dy * weight
+        self.mean_x += dx * other.n / n
+        self.mean_y += dy * other.n / n
+        self.n = n
+        self.hist += other.hist
+        return self
+
+    def fit(self) -> Tuple[float, float, float]:
+        """
+        Least squares line through all pairs, same as scipy.stats.linregress
+
+        Returns
+        -------
+        Tuple[float, float, float]
+            slope, offset and r value
+        """
+        slope = self.sxy / self.sxx
+        offset = self.mean_y - slope * self.mean_x
+        r_value = self.sxy / np.sqrt(self.sxx * self.syy)
+        return slope, offset, r_value
+
+    def plot(self, fig_size : int, xlabel : Union[str, None] = None, ylabel : Union[str, None] = None) -> Tuple[plt.Figure, float, float, float]:
+        """
+        Plot histogram and fit line from the accumulated statistics, same figure as get_pixel_hist2d
+
+        Parameters
+        ----------
+        fig_size : int
+            figure size,  inches
+        xlabel : Union[str, None], optional
+            x axis label, by default None
+        ylabel : Union[str, None], optional
+            y axis label, by default None
+
+        Returns
+        -------
+        Tuple[plt.Figure, float, float, float]
+            Figure handles, slope, offset and r value of a linear fit into the data
+        """
+        fig = plt.figure(figsize = (fig_size,fig_size))
+        plt.imshow(self.hist.T, interpolation='nearest', origin='lower',
+                  extent=[self.xedges[0], self.xedges[-1], self.yedges[0], self.yedges[-1]], aspect='auto', norm=LogNorm())
+        plt.colorbar()
+
+        slope, offset, r_value = self.fit()
+        fit_fn = np.poly1d([slope, offset])
+
+        plt.plot(self.xedges[[0, -1]], fit_fn(self.xedges[[0, -1]]), '--k')
+        plt.xlabel(xlabel)
+        plt.ylabel(ylabel)
+        plt.title(f"{fit_fn}, R2={np.around(r_value**2, decimals=2)}")
+        return fig, slope, offset, r_value
+
+def get_pixel_hist2d_chunks(chunks_1 : Iterable[np.array], chunks_2 : Iterable[np.array], bins : int, value_range : Tuple[Tuple[float, float], Tuple[float, float]], fig_size : int, xlabel : Union[str, None]=None, ylabel : Union[str, None]=None) -> Tuple[plt.Figure, float, float, float]:
+    """
+    Plot 2D histogram of pixel values of two paired movies streamed in chunks 
+    (e.g. io_utils.iter_chunks of two paired planes), see PixelHist2D
+
+    Parameters
+    ----------
+    chunks_1 : Iterable[np.array]
+        chunks of movie 1
+    chunks_2 : Iterable[np.array]
+        chunks of movie 2, same number and shapes as chunks_1
+    bins : int
+        bins to use for histogram along each axis
+    value_range : Tuple[Tuple[float, float], Tuple[float, float]]
+        ((x min, x max), (y min, y max)) covered by the bins
+    fig_size : int
+        figure size,  inches
+    xlabel : Union[str, None], optional
+        x axis label, by default None
+    ylabel : Union[str, None], optional
+        y axis label, by default None
+
+    Returns
+    -------
+    Tuple[plt.Figure, float, float, float]
+        Figure handles, slope, offset and r value of a linear fit into the data
+    """
+    hist2d = PixelHist2D(bins, value_range)
+    for chunk_1, chunk_2 in zip_longest(chunks_1, chunks_2):
+        assert chunk_1 is not None and chunk_2 is not None, "Movies have different number of chunks"
+        assert np.shape(chunk_1) == np.shape(chunk_2), f"Chunks have different shapes: {np.shape(chunk_1)}, {np.shape(chunk_2)}"
+        hist2d.update(chunk_1, chunk_2)
+    return hist2d.plot(fig_size, xlabel, ylabel)
+
 def image_plot(path : str) -> plt.Figure:
     """
     Creates a shows a figure with image at path
@@ -110,22 +284,163 @@ def plot_all_colormaps(image : np.array, cmaps : list = CMAPS) -> None:
         plt.close()
     return
 
-def average_intensity(path : str) -> np.array:
+def average_intensity(path : str, chunk_size : int = 500) -> np.array:
     """
-    Calculates average intensity over eahc plane in teimseries
+    Calculates average intensity over eahc plane in teimseries, reading it in chunks
 
     Parameters
     ----------
     path : str
-        Absolute apht ot the timseries
+        Absolute apht ot the timseries, can be a glob pattern
+    chunk_size : int, optional
+        number of planes read at once, by default 500
 
     Returns
     -------
     np.array
         vector with mean intensity values for each plane 
     """
-    image = tiff.imread(glob.glob(path))
-    return image.mean(axis=(1,2))
+    frame_means = []
+    for file_path in glob.glob(path):
+        for chunk in iter_chunks(file_path, chunk_size):
+            frame_means.append(chunk.mean(axis=(1,2)))
+    return np.concatenate(frame_means)
+
+def estimate_phase_offsets(stack : np.array, subpixel : bool = False, batch_size : int = 32) -> np.array:
+    """
+    Estimate bidirectional scanning phase offset of every frame in a stack.
+    Cross-correlates all pairs of lines (1,2), (3,4), ... of a batch of frames at once with rfft,
+    same pairs and lag range as np.correlate(..., mode='same') in align_phase, 
+    offset of a frame is the mean offset of its line pairs.
+
+    Parameters
+    ----------
+    stack : np.array
+        3D numpy array (frames, rows, columns) or a single 2D image
+    subpixel : bool, optional
+        if True, refine each line pair's peak with a parabolic fit and return unrounded offsets, 
+        if False - return integer offsets rounded same way as align_phase, by default False
+    batch_size : int, optional
+        number of frames correlated at once, bounds memory use, by default 32
+
+    Returns
+    -------
+    np.array
+        1D array with offset of each frame, int if subpixel is False, float otherwise
+    """
+    stack = np.asarray(stack)
+    if stack.ndim == 2:
+        stack = stack[np.newaxis]
+    width = stack.shape[2]
+    n_pairs = len(range(1, stack.shape[1]-1, 2))
+    fft_len = 2 * width
+    # lags covered by np.correlate(mode='same'), as indices into the circular correlation
+    lags = np.arange(-(width // 2), width - width // 2)
+    lag_index = lags % fft_len
+
+    offsets = np.empty(stack.shape[0], dtype=float)
+    for start in range(0, stack.shape[0], batch_size):
+        batch = stack[start:start+batch_size]
+        lines_a = np.asarray(batch[:, 1:2*n_pairs:2], dtype=np.float64)
+        lines_b = np.asarray(batch[:, 2:2*n_pairs+1:2], dtype=np.float64)
+        spectrum = np.fft.rfft(lines_a, n=fft_len) * np.conj(np.fft.rfft(lines_b, n=fft_len))
+        correlation = np.fft.irfft(spectrum, n=fft_len)[..., lag_index]
+        peak = np.argmax(correlation, axis=-1)
+        pair_offsets = -lags[peak].astype(float)
+        if subpixel:
+            inner = (peak > 0) & (peak < len(lags)-1)
+            left = np.take_along_axis(correlation, np.clip(peak-1, 0, None)[..., np.newaxis], axis=-1)[..., 0]
+            center = np.take_along_axis(correlation, peak[..., np.newaxis], axis=-1)[..., 0]
+            right = np.take_along_axis(correlation, np.clip(peak+1, None, len(lags)-1)[..., np.newaxis], axis=-1)[..., 0]
+            curvature = left - 2*center + right
+            valid = inner & (curvature < 0)
+            delta = np.zeros_like(center)
+            delta[valid] = (left[valid] - right[valid]) / (2*curvature[valid])
+            pair_offsets -= delta
+        offsets[start:start+batch_size] = pair_offsets.mean(axis=-1)
+
+    if subpixel:
+        return offsets
+    return np.round(offsets).astype(int)
+
+def apply_phase_offset(stack : np.array, offset : float, out : Union[np.array, None] = None, inplace : bool = False, chunk_size : int = 256) -> np.array:
+    """
+    Apply bidirectional phase offset to an image or a whole stack.
+    Lines are shifted against each other with one strided copy per chunk of frames, 
+    columns without data from both lines are cropped, so output is narrower by ceil(abs(offset)).
+    Integer offsets keep the input dtype, fractional offsets are applied with a Fourier shift in float32.
+
+    Parameters
+    ----------
+    stack : np.array
+        2D image or 3D (frames, rows, columns) array, can be a memmap or a h5py dataset
+    offset : float
+        offset as returned by estimate_phase_offsets, positive if odd lines are shifted right of even lines
+    out : Union[np.array, None], optional
+        array (e.g. memmap) to write the aligned stack into, of shape [..., rows, columns - ceil(abs(offset))], 
+        must have a float dtype for fractional offsets, by default a new array is allocated
+    inplace : bool, optional
+        if True, integer offset is applied inside stack and a cropped view of it is returned, by default False
+    chunk_size : int, optional
+        number of frames processed at once, bounds size of temporary arrays, by default 256
+
+    Returns
+    -------
+    np.array
+        phase-aligned image or stack
+
+    Raises
+    ------
+    ValueError
+        if a fractional offset is applied in place or into an integer out
+    """
+    width = stack.shape[-1]
+    crop = int(np.ceil(abs(offset)))
+    subpixel = offset != int(offset)
+    if subpixel and inplace:
+        raise ValueError(f"Fractional offset {offset} can't be applied in place")
+    if subpixel and out is not None and not np.issubdtype(out.dtype, np.floating):
+        raise ValueError(f"Fractional offset {offset} can't be written into out of type {out.dtype}")
+    # lines that get shifted left: even lines for positive offset, odd lines for negative
+    moving, fixed = (slice(0, None, 2), slice(1, None, 2)) if offset > 0 else (slice(1, None, 2), slice(0, None, 2))
+
+    if inplace:
+        if crop:
+            stack[..., moving, :width-crop] = stack[..., moving, crop:]
+        return stack[..., :width-crop]
+
+    if out is None:
+        out_dtype = np.float32 if subpixel else stack.dtype
+        out = np.empty(stack.shape[:-1] + (width-crop,), dtype=out_dtype)
+    if stack.ndim == 2:
+        _shift_lines(stack, out, moving, fixed, offset, crop)
+        return out
+    for start in range(0, stack.shape[0], chunk_size):
+        chunk = np.asarray(stack[start:start+chunk_size])
+        if isinstance(out, np.ndarray):
+            # numpy arrays and memmaps are written through a view, other outputs (e.g. h5py) by assignment
+            _shift_lines(chunk, out[start:start+chunk_size], moving, fixed, offset, crop)
+        else:
+            out[start:start+chunk_size] = _shift_lines(chunk, None, moving, fixed, offset, crop, out.dtype)
+    return out
+
+def _shift_lines(image : np.array, out : Union[np.array, None], moving : slice, fixed : slice, offset : float, crop : int, dtype : Union[type, None] = None) -> np.array:
+    """
+    Shift 'moving' lines of image or chunk left by abs(offset) and crop, see apply_phase_offset
+    """
+    width = image.shape[-1]
+    if out is None:
+        out = np.empty(image.shape[:-1] + (width-crop,), dtype=dtype)
+    out[..., fixed, :] = image[..., fixed, :width-crop]
+    if offset == int(offset):
+        out[..., moving, :] = image[..., moving, crop:]
+    else:
+        lines = np.asarray(image[..., moving, :], dtype=np.float32)
+        frequencies = np.fft.rfftfreq(width)
+        ramp = np.exp(2j*np.pi*frequencies*abs(offset)).astype(np.complex64)
+        shifted = np.fft.irfft(np.fft.rfft(lines) * ramp, n=width)
+        out[..., moving, :] = shifted[..., :width-crop]
+    return out
 
 def align_phase(image : np.array, do_align : bool = True, offset : Union[int, None] = None) -> Union[int, np.array]:
     """
@@ -148,32 +463,18 @@ def align_phase(image : np.array, do_align : bool = True, offset : Union[int, No
     """
     if not offset :
         # calculate mean offset in the frame:
-        offsets = []
-        i=1 
-        while i < len(image)-1 : # loop over each pair of lines to calculate pairwise correlation
-            offset = image.shape[0]/2 - np.argmax(np.correlate(image[i], image[i+1], mode='same'))
-            offsets.append(offset)
-            i += 2
-        offset = int(np.round(np.mean(offsets)))
+        offset = int(estimate_phase_offsets(image)[0])
     if do_align: 
         if offset > 0:
-            # move every line by offset/2
-            image_aligned = np.zeros((image.shape[0], int(image.shape[1]+offset)))
-
-            i=0
-            while i < len(image)-1: # loop over each pair of lines to insert original data with offset
-                image_aligned[i,: 0-offset] = image[i, :]
-                image_aligned[i+1, offset:] = image[i+1]
-                i += 2
-
-            image_aligned = image_aligned[:, 1:image_aligned.shape[1]-offset]
+            # shift even lines left by offset, crop columns not covered by both lines
+            image_aligned = apply_phase_offset(image, offset)
             return offset, image_aligned
         else:
             return offset, image
     else:
         return offset
 
-def align_phase_stack(stack : np.array) -> np.array:
+def align_phase_stack(stack : np.array, out : Union[np.array, None] = None, inplace : bool = False, subpixel : bool = False, offset : Union[float, None] = None) -> np.array:
     """
         Function to align phase in images in stack: calculate mean offset for all images, 
         apply same value to all images in stack
@@ -181,35 +482,266 @@ def align_phase_stack(stack : np.array) -> np.array:
     ----------
     stack : np.array
         3D numpy array representing stack
+    out : Union[np.array, None], optional
+        array (e.g. memmap) to write aligned stack into, see apply_phase_offset, 
+        must have a float dtype with subpixel or a fractional offset, by default None
+    inplace : bool, optional
+        if True, align inside stack and return a cropped view of it, integer offsets only, by default False
+    subpixel : bool, optional
+        if True, estimate and apply a fractional offset (output is float32), by default False
+    offset : Union[float, None], optional
+        if given (e.g. from PhaseOffsetRegistry), skip estimation and apply this offset, by default None
     Returns
     -------
     np.array
-        3D numpy array representing stack, but aligned
+        3D numpy array representing stack, but aligned, of the same dtype as input for integer offsets
+
+    Raises
+    ------
+    ValueError
+        if inplace is combined with subpixel or a fractional offset, 
+        or an integer out is combined with subpixel or a fractional offset
     """
+    if subpixel and inplace:
+        raise ValueError("subpixel alignment can't be done in place, pass out or inplace=False")
+    if subpixel and out is not None and not np.issubdtype(out.dtype, np.floating):
+        raise ValueError(f"subpixel alignment needs a float out, got {out.dtype}")
+    if offset is not None:
+        return apply_phase_offset(stack, offset, out=out, inplace=inplace)
     # calculate mean offset in the stack:
-    offsets = []
-    for page in stack:
-        offset = align_phase(page, do_align = False)
-        offsets.append(offset)
+    offsets = estimate_phase_offsets(stack, subpixel=subpixel)
+    if subpixel:
+        return apply_phase_offset(stack, float(np.mean(offsets)), out=out)
+    return apply_phase_offset(stack, combine_phase_offsets(offsets), out=out, inplace=inplace)
+
+def align_phase_movie(source : str, destination : str, chunk_size : int = 500, sample_chunks : int = 10, n_workers : int = 4, offset : Union[float, None] = None, subpixel : bool = False, field : str = 'data') -> float:
+    """
+    Align phase of a movie that doesn't fit in memory, in two passes:
+    1. estimate offset on sample_chunks chunks spread evenly over the movie
+    2. read the movie chunk by chunk in order (one open file), align chunks in a thread pool 
+    and written in order, so at most n_workers+1 chunks are in memory regardless of movie length
+
+    Parameters
+    ----------
+    source : str
+        path to the tiff or hdf5 movie
+    destination : str
+        path to the aligned movie to write, hdf5 if extension is .h5 or .hdf5, bigtiff otherwise
+    chunk_size : int, optional
+        number of frames in a chunk, by default 500
+    sample_chunks : int, optional
+        number of chunks used to estimate offset, by default 10
+    n_workers : int, optional
+        number of threads aligning chunks, by default 4
+    offset : Union[float, None], optional
+        if given (e.g. from PhaseOffsetRegistry), skip the first pass, by default None
+    subpixel : bool, optional
+        if True, estimate and apply a fractional offset (output is float32), by default False
+    field : str, optional
+        dataset with the movie in hdf5 files, by default 'data'
+
+    Returns
+    -------
+    float
+        offset applied to the movie
+    """
+    num_frames = get_num_frames(source, field)
+    if offset is None:
+        starts = np.unique(np.linspace(0, max(num_frames-chunk_size, 0), sample_chunks).astype(int))
+        offsets = np.concatenate([estimate_phase_offsets(read_frames(source, start, start+chunk_size, field, num_frames), subpixel=subpixel) 
+                                  for start in starts])
+        offset = float(np.mean(offsets)) if subpixel else combine_phase_offsets(offsets)
+
+    first_frame = read_frames(source, 0, 1, field, num_frames)
+    out_dtype = first_frame.dtype if offset == int(offset) else np.float32
+    out_shape = (num_frames, first_frame.shape[1], first_frame.shape[2]-int(np.ceil(abs(offset))))
+
+    # chunks are read in order through one open file, workers only shift them
+    with StackWriter(destination, out_shape, out_dtype, field) as writer, ThreadPoolExecutor(max_workers=n_workers) as executor:
+        pending = deque()
+        for chunk in iter_chunks(source, chunk_size, field):
+            pending.append(executor.submit(apply_phase_offset, chunk, offset))
+            # keep at most n_workers chunks in flight, write them in order
+            if len(pending) > n_workers:
+                writer.write(pending.popleft().result())
+        while pending:
+            writer.write(pending.popleft().result())
+    return offset
+
+def combine_phase_offsets(offsets : np.array) -> int:
+    """
+    Combine per-frame offsets into one offset for the stack: rounded mean, or max if mean rounds to 0
+
+    Parameters
+    ----------
+    offsets : np.array
+        integer offsets of frames, as returned by estimate_phase_offsets
+
+    Returns
+    -------
+    int
+        offset to apply to the whole stack
+    """
     mean_offset = int(np.round(np.mean(offsets)))
     max_offset = np.max(offsets)
     # align all images in stack using mean or max offset: 
 
     if mean_offset !=0:
-        offset = mean_offset
+        return mean_offset
     else:
-        offset = max_offset
+        return int(max_offset)
+
+PHASE_KEY_FIELDS = ['SI.hRoiManager.scanZoomFactor', 'SI.hRoiManager.linePeriod', 
+                    'SI.hRoiManager.pixelsPerLine', 'SI.hRoiManager.linesPerFrame',
+                    'SI.hScan2D.linePhase', 'SI.hScan2D.scannerFrequency', 'SI.hScan2D.fillFractionSpatial']
+
+class PhaseOffsetRegistry():
+    """
+    Registry of bidirectional phase offsets estimated for previous files, keyed by rig and
+    the ScanImage parameters the offset depends on (zoom, line rate, resolution, line phase setting).
+    For every key it keeps how many frames came from files that got each stack offset (combine_phase_offsets,
+    the same rule used when the offset is estimated), confidence of a cached offset is the fraction of frames 
+    from files that agree with it. Stored as a json file.
+    """
+    def __init__(self, path : Union[str, None] = None):
+        """
+        Parameters
+        ----------
+        path : Union[str, None], optional
+            json file to load the registry from and save it to, by default None (in memory only)
+        """
+        self.path = path
+        self.entries = {}
+        if path is not None and os.path.isfile(path):
+            with open(path, encoding='UTF-8') as registry_file:
+                self.entries = json.load(registry_file)
+
+    @staticmethod
+    def get_key(metadata : Union[tuple, dict], rig : Union[str, None] = None) -> str:
+        """
+        Build registry key from ScanImage metadata
 
-    stack_aligned = np.zeros((stack.shape[0], stack.shape[1], stack.shape[2]-offset))
+        Parameters
+        ----------
+        metadata : Union[tuple, dict]
+            full ScanImage metadata as returned by read_scanimage_metadata, or its general (first) part
+        rig : Union[str, None], optional
+            rig name, by default None
 
-    for i, page in enumerate(stack):
-        _, page_aligned = align_phase(page, offset = offset)
-        stack_aligned[i] = page_aligned
-    return stack_aligned
+        Returns
+        -------
+        str
+            key, stable across sessions with the same acquisition parameters
+        """
+        md_general = metadata[0] if isinstance(metadata, (tuple, list)) else metadata
+        params = {'rig': rig}
+        params.update({field: md_general.get(field) for field in PHASE_KEY_FIELDS})
+        return json.dumps(params, sort_keys=True)
+
+    def record(self, metadata : Union[tuple, dict], offsets : np.array, rig : Union[str, None] = None) -> None:
+        """
+        Add the stack offset of a file (combine_phase_offsets of its per-frame offsets) to the registry, 
+        weighted by its number of frames
+
+        Parameters
+        ----------
+        metadata : Union[tuple, dict]
+            ScanImage metadata of the file
+        offsets : np.array
+            offsets as returned by estimate_phase_offsets
+        rig : Union[str, None], optional
+            rig name, by default None
+        """
+        counts = self.entries.setdefault(self.get_key(metadata, rig), {})
+        offset = str(combine_phase_offsets(offsets))
+        counts[offset] = counts.get(offset, 0) + len(offsets)
+
+    def lookup(self, metadata : Union[tuple, dict], rig : Union[str, None] = None, min_samples : int = 100, min_confidence : float = 0.9) -> Union[Tuple[int, float, int], None]:
+        """
+        Get cached offset for a file with given metadata
+
+        Parameters
+        ----------
+        metadata : Union[tuple, dict]
+            ScanImage metadata of the file
+        rig : Union[str, None], optional
+            rig name, by default None
+        min_samples : int, optional
+            minimal number of frames recorded for the key, by default 100
+        min_confidence : float, optional
+            minimal fraction of recorded frames from files agreeing with the offset, by default 0.9
+
+        Returns
+        -------
+        Union[Tuple[int, float, int], None]
+            (offset, confidence, number of samples), or None if there is no reliable cached offset
+        """
+        counts = self.entries.get(self.get_key(metadata, rig))
+        if not counts:
+            return None
+        samples = sum(counts.values())
+        offset = max(counts, key=counts.get)
+        confidence = counts[offset] / samples
+        if samples < min_samples or confidence < min_confidence:
+            return None
+        return int(offset), confidence, samples
+
+    def get_offset(self, stack : np.array, metadata : Union[tuple, dict], rig : Union[str, None] = None, spot_check : float = 0.0, spot_frames : int = 10, **lookup_kwargs) -> int:
+        """
+        Offset to apply to a stack: cached if the registry has a reliable one for its metadata, 
+        estimated from pixels (and recorded) otherwise. A spot check estimates the offset on a few frames 
+        and falls back to estimating it from the whole stack if it doesn't agree with the cached one.
+
+        Parameters
+        ----------
+        stack : np.array
+            3D numpy array representing stack
+        metadata : Union[tuple, dict]
+            ScanImage metadata of the stack
+        rig : Union[str, None], optional
+            rig name, by default None
+        spot_check : float, optional
+            probability to re-estimate offset on a few frames even if it's cached, by default 0.0
+        spot_frames : int, optional
+            number of randomly chosen frames used in a spot check, by default 10
+        lookup_kwargs : 
+            min_samples, min_confidence passed to lookup
+
+        Returns
+        -------
+        int
+            offset for the whole stack
+        """
+        cached = self.lookup(metadata, rig, **lookup_kwargs)
+        if cached is not None:
+            if np.random.random() >= spot_check:
+                return cached[0]
+            frames = np.sort(np.random.choice(len(stack), min(spot_frames, len(stack)), replace=False))
+            spot_offsets = estimate_phase_offsets(np.asarray(stack[frames]))
+            if combine_phase_offsets(spot_offsets) == cached[0]:
+                self.record(metadata, spot_offsets, rig)
+                return cached[0]
+        offsets = estimate_phase_offsets(stack)
+        self.record(metadata, offsets, rig)
+        return combine_phase_offsets(offsets)
+
+    def save(self, path : Union[str, None] = None) -> None:
+        """
+        Write registry to a json file
+
+        Parameters
+        ----------
+        path : Union[str, None], optional
+            file to write, by default the file it was loaded from
+        """
+        path = path or self.path
+        with open(path, 'w', encoding='UTF-8') as registry_file:
+            json.dump(self.entries, registry_file, indent=2)
 
 def average_n(array : np.array, downsampling_factor : int) -> np.array:
     """
-    Average every N frames of the timeseries
+    Average every N consecutive frames of the timeseries, see bin_chunks.
+    If number of frames is not divisible by N, last frame is the average of the remaining frames.
     Parameters
     ----------
     array : np.array
@@ -219,52 +751,212 @@ def average_n(array : np.array, downsampling_factor : int) -> np.array:
     Returns
     -------
     np.array
-        averaged timeseries
+        averaged timeseries, float32
     """    
-    reshaped_array = array.reshape(downsampling_factor, int(array.shape[0]/downsampling_factor), array.shape[1], array.shape[2])
-    avg_array = reshaped_array.mean(axis=0)
-    return avg_array
+    return np.concatenate(list(bin_chunks([array], downsampling_factor)))
+
+def _block_mean(data : np.array, factors : Union[int, tuple]) -> np.array:
+    """
+    Mean over nonoverlapping blocks of the last two axes (integer downsampling), 
+    rows and columns that don't fill a whole block are cropped; accumulates in float64 for float64 data, float32 otherwise
+    """
+    factor_y, factor_x = (factors, factors) if np.isscalar(factors) else factors
+    rows = data.shape[-2] // factor_y
+    cols = data.shape[-1] // factor_x
+    data = data[..., :rows*factor_y, :cols*factor_x]
+    blocks = data.reshape(data.shape[:-2] + (rows, factor_y, cols, factor_x))
+    dtype = np.float64 if data.dtype == np.float64 else np.float32
+    return blocks.mean(axis=(-3, -1), dtype=dtype)
 
-def image_negative_rescale(data : np.array) -> np.array:  
+def bin_chunks(chunks : Iterable[np.array], factor : int, spatial_factor : int = 1, keep_tail : bool = True) -> Iterator[np.array]:
     """
-    Mapping image to non-negative range
+    Streaming temporal binning: average groups of `factor` consecutive frames coming in chunks 
+    of any size (e.g. from io_utils.iter_chunks), groups can span chunk boundaries.
+    Optionally also averages spatial_factor x spatial_factor pixel blocks. Accumulates in float32.
+
+    Parameters
+    ----------
+    chunks : Iterable[np.array]
+        3D numpy arrays (frames, rows, columns)
+    factor : int
+        number of consecutive frames to average
+    spatial_factor : int, optional
+        size of pixel blocks to average, by default 1 (no spatial binning)
+    keep_tail : bool, optional
+        if True, frames left over at the end (fewer than factor) are averaged into a last frame, 
+        if False - dropped, by default True
+
+    Yields
+    ------
+    np.array
+        3D float32 numpy array with binned frames
+    """
+    def _spatial(frames):
+        return _block_mean(frames, spatial_factor) if spatial_factor > 1 else frames
+
+    remainder = None
+    for chunk in chunks:
+        start = 0
+        if remainder is not None and len(remainder):
+            # complete the group started in the previous chunk
+            needed = factor - len(remainder)
+            if len(chunk) < needed:
+                remainder = np.concatenate([remainder, chunk])
+                continue
+            group_sum = remainder.sum(axis=0, dtype=np.float32) + chunk[:needed].sum(axis=0, dtype=np.float32)
+            yield _spatial((group_sum / factor)[np.newaxis])
+            start = needed
+        num_groups = (len(chunk) - start) // factor
+        stop = start + num_groups * factor
+        if num_groups:
+            groups = chunk[start:stop].reshape((num_groups, factor) + chunk.shape[1:])
+            yield _spatial(groups.mean(axis=1, dtype=np.float32))
+        remainder = np.array(chunk[stop:])
+    if keep_tail and remainder is not None and len(remainder):
+        yield _spatial(remainder.mean(axis=0, dtype=np.float32)[np.newaxis])
+
+def bin_movie(source : str, destination : str, factor : int, spatial_factor : int = 1, chunk_size : int = 500, keep_tail : bool = True, field : str = 'data') -> None:
+    """
+    Write temporally (and optionally spatially) binned preview of a tiff or hdf5 movie, 
+    reading it in chunks, see bin_chunks
+
+    Parameters
+    ----------
+    source : str
+        path to the tiff or hdf5 movie
+    destination : str
+        path to the binned movie, hdf5 if extension is .h5 or .hdf5, bigtiff otherwise
+    factor : int
+        number of consecutive frames to average
+    spatial_factor : int, optional
+        size of pixel blocks to average, by default 1
+    chunk_size : int, optional
+        number of frames read at once, by default 500
+    keep_tail : bool, optional
+        if True, average frames left over at the end into a last frame, by default True
+    field : str, optional
+        dataset with the movie in hdf5 files, by default 'data'
+    """
+    num_frames = get_num_frames(source, field)
+    frame_shape = read_frames(source, 0, 1, field).shape[1:]
+    num_binned = num_frames // factor + (1 if keep_tail and num_frames % factor else 0)
+    out_shape = (num_binned, frame_shape[0] // spatial_factor, frame_shape[1] // spatial_factor)
+    with StackWriter(destination, out_shape, np.float32, field) as writer:
+        for binned in bin_chunks(iter_chunks(source, chunk_size, field), factor, spatial_factor, keep_tail):
+            writer.write(binned)
+
+def image_negative_rescale(data : np.array, out : Union[np.array, None] = None, per_frame : bool = False) -> np.array:  
+    """
+    Mapping image to non-negative range: full uint16 range [0, 65535], see rescale_intensity
 
     Parameters
     ----------
     data : np.array
-        image as a 2D nupmy array
+        image as a 2D nupmy array, or a 3D stack
+    out : Union[np.array, None], optional
+        uint16 array to write the result into (can be data itself if it's uint16), by default a new array
+    per_frame : bool, optional
+        if True, rescale every frame of a stack by its own min and max, by default False
 
     Returns
     -------
     np.array
         image with pixel values remapped to a non-negative range
     """    
-    max_intensity = np.max(data)
-    min_intensity = np.min(data)
-    data_out = ((data - min_intensity)*2**16/(max_intensity-min_intensity)).astype(np.uint16)
-    return data_out
+    return rescale_intensity(data, out=out, per_frame=per_frame, out_dtype=np.uint16)
+
+def rescale_intensity(data : np.array, out : Union[np.array, None] = None, per_frame : bool = False, out_dtype : Union[type, np.dtype] = np.uint16, block_size : int = 2**20) -> np.array:
+    """
+    Linearly map data from its [min, max] to the full range of out_dtype ([0, 1] for floats).
+    Min and max are computed once (per frame if per_frame), data is then converted in blocks of 
+    about block_size pixels written straight into out, so temporaries stay small: 
+    8 and 16 bit unsigned data go through a lookup table with an entry per possible value, 
+    other data through float64 ufuncs with out= on one block at a time.
+
+    Parameters
+    ----------
+    data : np.array
+        2D image or 3D stack, can be a memmap
+    out : Union[np.array, None], optional
+        array of data's shape and out_dtype to write into (can be data itself, or a memmap), by default a new array
+    per_frame : bool, optional
+        if True, rescale every frame of a 3D stack by its own min and max, by default False
+    out_dtype : Union[type, np.dtype], optional
+        data type of the result, by default np.uint16
+    block_size : int, optional
+        approximate number of pixels converted at once, by default 2**20
+
+    Returns
+    -------
+    np.array
+        rescaled data (out)
+    """
+    out_dtype = np.dtype(out_dtype)
+    if out is None:
+        out = np.empty(data.shape, dtype=out_dtype)
+    if per_frame and data.ndim == 3:
+        for frame, frame_out in zip(data, out):
+            _rescale_into(frame, frame_out, frame.min(), frame.max(), block_size)
+    else:
+        _rescale_into(data, out, data.min(), data.max(), block_size)
+    return out
 
-def image_downsample(data : np.array, scaling_factor : int) -> np.array:
+def _rescale_into(data : np.array, out : np.array, min_intensity : float, max_intensity : float, block_size : int) -> None:
     """
-    Donwssampling image data according ot the sampling factor
+    Write data linearly mapped from [min_intensity, max_intensity] to range of out.dtype into out, 
+    in blocks along the first axis, see rescale_intensity
+    """
+    out_max = np.iinfo(out.dtype).max if np.issubdtype(out.dtype, np.integer) else 1.0
+    intensity_range = float(max_intensity) - float(min_intensity)
+    if not intensity_range:
+        # constant data maps to 0
+        out_max, intensity_range = 0.0, 1.0
+    use_lut = data.dtype in (np.uint8, np.uint16)
+    if use_lut:
+        values = np.arange(np.iinfo(data.dtype).max + 1, dtype=np.float64)
+        lut = np.clip((values - float(min_intensity)) * out_max / intensity_range, 0, out_max).astype(out.dtype)
+    step = max(1, block_size // max(1, int(np.prod(data.shape[1:]))))
+    for start in range(0, data.shape[0], step):
+        block = data[start:start+step]
+        if use_lut:
+            out[start:start+step] = lut[block]
+        else:
+            scaled = np.subtract(block, min_intensity, dtype=np.float64)
+            np.multiply(scaled, out_max, out=scaled)
+            np.divide(scaled, intensity_range, out=scaled)
+            np.clip(scaled, 0, out_max, out=scaled)
+            out[start:start+step] = scaled
+
+def image_downsample(data : np.array, scaling_factor : Union[float, tuple]) -> np.array:
+    """
+    Donwssampling image data according ot the sampling factor, keeping its dtype.
+    Integer factors use a block mean (reshape and mean), other factors - skimage resize with anti-aliasing.
+    A 3D array (N, y, x) is treated as a stack of images, all downsampled in one vectorized call.
 
     Parameters
     ----------
     data : np.array
-        2d numpy array representing the image
-    scaling_factor : int
-        scaling factor
+        2d numpy array representing the image, or 3d array with a stack of images
+    scaling_factor : Union[float, tuple]
+        scaling factor, same for both axes or one per axis (rows, columns)
 
     Returns
     -------
     np.array
-        downsampled image in a numpy array
+        downsampled image (or stack) in a numpy array of the same dtype as data
     """    
-    data_scaled_shape = np.asarray(data.shape / scaling_factor, dtype=int)
-    data_scaled = (resize(data, data_scaled_shape)*2**16).astype(np.uint16)
-    return data_scaled
+    factors = np.broadcast_to(np.asarray(scaling_factor, dtype=float), (2,))
+    if np.allclose(factors, np.round(factors)) and np.all(factors >= 1):
+        data_scaled = _block_mean(data, tuple(int(factor) for factor in np.round(factors)))
+    else:
+        data_scaled_shape = np.asarray(np.asarray(data.shape[-2:]) / factors, dtype=int)
+        data_scaled = resize(data, data.shape[:-2] + tuple(data_scaled_shape), preserve_range=True, anti_aliasing=True)
+    if np.issubdtype(data.dtype, np.integer):
+        info = np.iinfo(data.dtype)
+        data_scaled = np.clip(np.round(data_scaled), info.min, info.max)
+    return data_scaled.astype(data.dtype)
 
-def offset_to_zero(image : np.array) -> np.array:
+def offset_to_zero(image : np.array, out : Union[np.array, None] = None) -> np.array:
     """
     Offset image to zero
 
@@ -272,6 +964,8 @@ def offset_to_zero(image : np.array) -> np.array:
     ----------
     image : np.array
         2D numpyt array representing image
+    out : Union[np.array, None], optional
+        array to write the result into, pass image itself to offset in place, by default a new array
 
     Returns
     -------
@@ -279,7 +973,7 @@ def offset_to_zero(image : np.array) -> np.array:
         2D numpy array representing offset image
     """    
     imin = image.min()
-    im_offset = image-imin
+    im_offset = np.subtract(image, imin, out=out, casting='unsafe')
     return im_offset
 
 def compute_contrast(image : np.array, percentile_max : int = 95, percentile_min : int = 5, stack : bool = False) -> float:
@@ -306,12 +1000,206 @@ def compute_contrast(image : np.array, percentile_max : int = 95, percentile_min
         i_max = np.percentile(image, percentile_max, axis=2)
         i_min = np.percentile(image, percentile_min, axis=2)
         contrast = (i_max-i_min)/(i_max+i_min)
+    elif image.dtype in (np.uint8, np.uint16):
+        # exact percentiles from one linear pass over the image
+        histogram = IntensityHistogram(image.dtype).update(image)
+        contrast = histogram.contrast(percentile_max, percentile_min)
     else:
         i_max = np.percentile(image, percentile_max)
         i_min = np.percentile(image, percentile_min)
         contrast = (i_max-i_min)/(i_max+i_min)
     return contrast
 
+class IntensityHistogram():
+    """
+    Intensity histogram that can be accumulated over chunks of data and gives percentiles, 
+    contrast, saturation fraction and dark level from the same counts.
+    For integer data up to 16 bit every value has its own bin (65536 bins for uint16, via np.bincount), 
+    so percentiles are exact and match np.percentile (linear interpolation).
+    For float data and wider integers values are binned into `bins` equal bins over `value_range` 
+    (values outside are clipped to it), percentiles are approximate: 
+    they are the centers of the bins, so the error is at most half a bin width.
+    """
+    def __init__(self, dtype : Union[type, np.dtype] = np.uint16, value_range : Union[tuple, None] = None, bins : int = 65536):
+        """
+        Parameters
+        ----------
+        dtype : Union[type, np.dtype], optional
+            data type of the data to accumulate, by default np.uint16
+        value_range : Union[tuple, None], optional
+            (min, max) value to count, required for float data and integers wider than 16 bit, 
+            by default the full range of an 8 or 16 bit integer dtype
+        bins : int, optional
+            number of bins for float data and integers wider than 16 bit, by default 65536
+        """
+        self.dtype = np.dtype(dtype)
+        self.exact = np.issubdtype(self.dtype, np.integer) and np.iinfo(self.dtype).bits <= 16
+        if self.exact:
+            if value_range is None:
+                info = np.iinfo(self.dtype)
+                value_range = (int(info.min), int(info.max))
+            self.bins = int(value_range[1]) - int(value_range[0]) + 1
+        else:
+            assert value_range is not None, f"value_range is needed for {self.dtype} data"
+            self.bins = bins
+        self.value_range = value_range
+        self.counts = np.zeros(self.bins, dtype=np.int64)
+
+    def update(self, data : np.array) -> 'IntensityHistogram':
+        """
+        Add data (image, stack or chunk of any shape) to the histogram
+
+        Parameters
+        ----------
+        data : np.array
+            data to count
+
+        Returns
+        -------
+        IntensityHistogram
+            self, updated
+        """
+        low, high = self.value_range
+        data = np.asarray(data).ravel()
+        if self.exact:
+            if data.dtype in (np.uint8, np.uint16) and low == 0 and high >= np.iinfo(data.dtype).max:
+                self.counts += np.bincount(data, minlength=self.bins)[:self.bins]
+            else:
+                indices = np.clip(data, low, high).astype(np.int64) - low
+                self.counts += np.bincount(indices, minlength=self.bins)
+        else:
+            counts, _ = np.histogram(np.clip(data, low, high), bins=self.bins, range=self.value_range)
+            self.counts += counts
+        return self
+
+    def merge(self, other : 'IntensityHistogram') -> 'IntensityHistogram':
+        """
+        Add counts of another histogram with the same bins
+
+        Parameters
+        ----------
+        other : IntensityHistogram
+            histogram of other data
+
+        Returns
+        -------
+        IntensityHistogram
+            self, updated
+        """
+        assert self.bins == other.bins and self.value_range == other.value_range, "Histograms have different bins"
+        self.counts += other.counts
+        return self
+
+    @property
+    def n(self) -> int:
+        """Number of values counted"""
+        return int(self.counts.sum())
+
+    def _bin_values(self, bin_indices : np.array) -> np.array:
+        low, high = self.value_range
+        if self.exact:
+            return bin_indices + low
+        bin_width = (high - low) / self.bins
+        return low + (bin_indices + 0.5) * bin_width
+
+    def percentile(self, q : Union[float, np.array]) -> Union[float, np.array]:
+        """
+        Percentile(s) of the counted data, same definition as np.percentile (linear interpolation)
+
+        Parameters
+        ----------
+        q : Union[float, np.array]
+            percentile or array of percentiles, 0 - 100
+
+        Returns
+        -------
+        Union[float, np.array]
+            value(s) at the percentile(s)
+        """
+        q = np.asarray(q, dtype=float)
+        cumulative = np.cumsum(self.counts)
+        n = cumulative[-1]
+        rank = q / 100 * (n - 1)
+        rank_low = np.floor(rank).astype(np.int64)
+        rank_high = np.minimum(rank_low + 1, n - 1)
+        # value of k-th sorted element is the first bin whose cumulative count exceeds k
+        value_low = self._bin_values(np.searchsorted(cumulative, rank_low, side='right'))
+        value_high = self._bin_values(np.searchsorted(cumulative, rank_high, side='right'))
+        result = value_low + (rank - rank_low) * (value_high - value_low)
+        return float(result) if result.ndim == 0 else result
+
+    def contrast(self, percentile_max : float = 95, percentile_min : float = 5) -> float:
+        """
+        Contrast as in compute_contrast: (i_max-i_min)/(i_max+i_min)
+        """
+        i_max, i_min = self.percentile([percentile_max, percentile_min])
+        return (i_max-i_min)/(i_max+i_min)
+
+    def saturation_fraction(self, saturation_value : Union[float, None] = None) -> float:
+        """
+        Fraction of values at or above saturation_value, by default the top of the value range
+        """
+        if saturation_value is None:
+            saturation_value = self.value_range[1]
+        if self.exact:
+            first_bin = int(np.ceil(saturation_value)) - self.value_range[0]
+        else:
+            first_bin = min(int((saturation_value - self.value_range[0]) / (self.value_range[1] - self.value_range[0]) * self.bins), self.bins-1)
+        return float(self.counts[max(first_bin, 0):].sum() / self.n)
+
+    def stats(self, percentile_max : float = 95, percentile_min : float = 5, dark_percentile : float = 1, saturation_value : Union[float, None] = None) -> dict:
+        """
+        All histogram metrics at once
+
+        Returns
+        -------
+        dict
+            i_max, i_min (values at percentile_max and percentile_min), contrast, 
+            saturation (fraction of saturated values), dark_level (value at dark_percentile)
+        """
+        i_max, i_min, dark_level = self.percentile([percentile_max, percentile_min, dark_percentile]).tolist()
+        return {'i_max': i_max, 'i_min': i_min, 'contrast': (i_max-i_min)/(i_max+i_min),
+                'saturation': self.saturation_fraction(saturation_value), 'dark_level': dark_level}
+
+def compute_histogram_stats(image : np.array, percentile_max : float = 95, percentile_min : float = 5, dark_percentile : float = 1, saturation_value : Union[float, None] = None, per_frame : bool = False, value_range : Union[tuple, None] = None, bins : int = 65536) -> dict:
+    """
+    Compute percentiles, contrast, saturation fraction and dark level of an image or stack 
+    from its intensity histogram (one linear pass, exact for 8 and 16 bit integer data), see IntensityHistogram
+
+    Parameters
+    ----------
+    image : np.array
+        2D image or 3D stack (frames, rows, columns)
+    percentile_max : float, optional
+        Percentile at which to compute maximum value of the image, by default 95
+    percentile_min : float, optional
+        Percentile at which to compute minimum value of the image, by default 5
+    dark_percentile : float, optional
+        Percentile used as dark level estimate, by default 1
+    saturation_value : Union[float, None], optional
+        values at or above it count as saturated, by default max of the dtype or value_range
+    per_frame : bool, optional
+        if True, compute metrics for every frame of a stack, by default False (whole stack)
+    value_range : Union[tuple, None], optional
+        (min, max) for float data and integers wider than 16 bit, by default image min and max (approximate mode)
+    bins : int, optional
+        number of bins for float data and integers wider than 16 bit, by default 65536
+
+    Returns
+    -------
+    dict
+        i_max, i_min, contrast, saturation, dark_level; arrays with a value per frame if per_frame is True
+    """
+    exact = np.issubdtype(image.dtype, np.integer) and np.iinfo(image.dtype).bits <= 16
+    if value_range is None and not exact:
+        value_range = (float(image.min()), float(image.max()))
+    frames = image if per_frame else [image]
+    all_stats = [IntensityHistogram(image.dtype, value_range, bins).update(frame).stats(percentile_max, percentile_min, dark_percentile, saturation_value) 
+                 for frame in frames]
+    if not per_frame:
+        return all_stats[0]
+    return {key: np.array([frame_stats[key] for frame_stats in all_stats]) for key in all_stats[0]}
+
 def compute_acutance(image: np.ndarray, stack : bool = False) -> float:
     """
     Compute the acutance (sharpness) of an image.
@@ -321,21 +1209,19 @@ def compute_acutance(image: np.ndarray, stack : bool = False) -> float:
     image : np.ndarray
         Image to compute acutance of.
     stack : bool, optional
-        Whether input is a stack (tiemseries, 3D array), or a single image (2D array), by default False
+        Whether input is a 4D block view (as made by view_as_blocks in compute_block_snr), 
+        or a single image (2D array), by default False
 
     Returns
     -------
     float
-        Acutance of the image.
+        Acutance of the image, or list of acutance of every block if stack is True.
     """    
     if stack:
-        accutance = []
-        for i in range(image.shape[0]):
-            for j in range(image.shape[1]):
-                block = image[i,j,:,:]
-                grady, gradx = np.gradient(block)
-                a = (grady ** 2 + gradx ** 2).mean()
-                accutance.append(a)
+        # gradients within every block of the 4D block view at once
+        grady, gradx = np.gradient(image, axis=(2,3))
+        accutance = (grady ** 2 + gradx ** 2).mean(axis=(2,3))
+        accutance = list(accutance.flatten())
     else:
         grady, gradx = np.gradient(image)
         accutance = (grady ** 2 + gradx ** 2).mean() #to-do: Normalize by mean
@@ -388,23 +1274,149 @@ def compute_photon_flux(image: np.ndarray, stack : bool = False) -> float:
         photon_flux = np.sqrt(np.mean(image.flatten()))
         return photon_flux
 
-def compute_temporal_variance(image_stack: np.array) -> float :
+def compute_temporal_variance(image_stack: Union[np.array, str], chunk_size : int = 500, n_workers : int = 1) -> float :
     """
     compute_temporal_variance computes mean variance of pixel values in an image stack
     this is to incorporate temporal variance (biological activity) into imaging quality metric
     Parameters
     ----------
-    image_stack : np.array
-        image time series
+    image_stack : Union[np.array, str]
+        image time series, or path to a tiff/hdf5 movie to stream through compute_temporal_stats
+    chunk_size : int, optional
+        frames read at once when image_stack is a path, by default 500
+    n_workers : int, optional
+        threads reading the movie when image_stack is a path, by default 1
 
     Returns
     -------
     float
         temporal variance
     """
-    image_variance = np.var(image_stack, axis=0)
+    if isinstance(image_stack, str):
+        image_variance = compute_temporal_stats(image_stack, chunk_size, n_workers).variance
+    else:
+        image_variance = np.var(image_stack, axis=0)
     return image_variance.mean(axis=(0,1))
 
+class TemporalStats():
+    """
+    Single pass accumulator of per-pixel temporal statistics of a movie: mean, variance, min, max, 
+    and mean of every frame. Chunks are added with update, partial results of workers 
+    processing consecutive parts of a movie are combined with merge (Chan et al. pairwise update),
+    so memory stays at a few float64 images however long the movie is.
+    """
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+        self.min = None
+        self.max = None
+        self._frame_means = []
+
+    def update(self, chunk : np.array) -> 'TemporalStats':
+        """
+        Add frames to the statistics
+
+        Parameters
+        ----------
+        chunk : np.array
+            3D numpy array (frames, rows, columns)
+
+        Returns
+        -------
+        TemporalStats
+            self, updated
+        """
+        if len(chunk) == 0:
+            return self
+        chunk_stats = TemporalStats()
+        chunk_stats.n = len(chunk)
+        chunk_float = np.asarray(chunk, dtype=np.float64)
+        chunk_stats.mean = chunk_float.mean(axis=0)
+        chunk_stats.m2 = ((chunk_float - chunk_stats.mean) ** 2).sum(axis=0)
+        chunk_stats.min = chunk.min(axis=0)
+        chunk_stats.max = chunk.max(axis=0)
+        chunk_stats._frame_means = [chunk_float.mean(axis=(1,2))]
+        return self.merge(chunk_stats)
+
+    def merge(self, other : 'TemporalStats') -> 'TemporalStats':
+        """
+        Combine with statistics of the frames that follow in the movie
+
+        Parameters
+        ----------
+        other : TemporalStats
+            statistics of later frames
+
+        Returns
+        -------
+        TemporalStats
+            self, updated
+        """
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.n, self.mean, self.m2 = other.n, other.mean, other.m2
+            self.min, self.max = other.min, other.max
+            self._frame_means = list(other._frame_means)
+            return self
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.n / n)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * (self.n * other.n / n)
+        self.n = n
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self._frame_means += other._frame_means
+        return self
+
+    @property
+    def variance(self) -> np.array:
+        """Per-pixel variance over time (ddof=0, as np.var)"""
+        return self.m2 / self.n
+
+    @property
+    def frame_means(self) -> np.array:
+        """Mean intensity of every frame, in order"""
+        return np.concatenate(self._frame_means) if self._frame_means else np.array([])
+
+def compute_temporal_stats(path : str, chunk_size : int = 500, n_workers : int = 1, field : str = 'data') -> TemporalStats:
+    """
+    Compute per-pixel temporal statistics of a tiff or hdf5 movie in one streaming pass.
+    With n_workers > 1 the movie is split in consecutive parts read in threads, their results are merged.
+
+    Parameters
+    ----------
+    path : str
+        path to the tiff or hdf5 movie
+    chunk_size : int, optional
+        number of frames read at once, by default 500
+    n_workers : int, optional
+        number of threads, by default 1
+    field : str, optional
+        dataset with the movie in hdf5 files, by default 'data'
+
+    Returns
+    -------
+    TemporalStats
+        accumulated statistics: mean, variance, min, max, frame_means
+    """
+    num_frames = get_num_frames(path, field)
+    bounds = np.linspace(0, num_frames, n_workers+1).astype(int)
+
+    def _accumulate(start, stop):
+        stats = TemporalStats()
+        for chunk in iter_chunks(path, chunk_size, field, start, stop):
+            stats.update(chunk)
+        return stats
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        partial_stats = list(executor.map(_accumulate, bounds[:-1], bounds[1:]))
+    stats = TemporalStats()
+    for partial in partial_stats:
+        stats.merge(partial)
+    return stats
+
 def compute_block_snr(image : np.ndarray, block_shape : tuple, blocks_to_agg : tuple, return_block : bool = False, snr_metric : str = "basic") -> Union[float, tuple]:
     """
     Compute the SNR of nonoverlapping blocks of an image, return aggregate
@@ -447,3 +1459,73 @@ def compute_block_snr(image : np.ndarray, block_shape : tuple, blocks_to_agg : t
         return block_snr, mean_block_snr
     else:
         return mean_block_snr
+
+BLOCK_METRICS = ["mean", "std", "basic", "photon_flux", "acutance", "contrast"]
+
+def compute_block_metrics(image : np.ndarray, block_shape : tuple, metrics : list = BLOCK_METRICS, percentile_max : int = 95, percentile_min : int = 5) -> pd.DataFrame:
+    """
+    Compute several metrics of nonoverlapping blocks of an image, or of every frame of a stack, 
+    from one block view: mean and mean of squares are reduced once and shared by 
+    std, basic SNR (std/mean) and photon flux (sqrt(mean)); acutance and contrast are 
+    computed over the same view, same definitions as compute_acutance and compute_contrast.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        2D image, or 3D stack (frames, rows, columns) to get block maps per frame
+    block_shape : tuple
+        Shape of blocks (rows, columns), has to divide image shape
+    metrics : list, optional
+        any subset of ["mean", "std", "basic", "photon_flux", "acutance", "contrast"], by default all
+    percentile_max : int, optional
+        Percentile at which to compute maximum value of a block for contrast, by default 95
+    percentile_min : int, optional
+        Percentile at which to compute minimum value of a block for contrast, by default 5
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per block: frame (for 3D input only), block_row, block_col, 
+        y, x (pixel coordinates of the top left corner of the block), and a column per metric
+    """
+    unknown = set(metrics) - set(BLOCK_METRICS)
+    assert not unknown, f"Unknown block metrics {unknown}, has to be from {BLOCK_METRICS}"
+    is_stack = image.ndim == 3
+    if is_stack:
+        view = view_as_blocks(image, block_shape=(1,) + tuple(block_shape))[:, :, :, 0]
+    else:
+        view = view_as_blocks(image, block_shape=tuple(block_shape))[np.newaxis]
+    # view is [frames, block rows, block columns, block height, block width]
+    block_axes = (3, 4)
+    frames, block_rows, block_cols = view.shape[:3]
+    frame_idx, row_idx, col_idx = np.meshgrid(np.arange(frames), np.arange(block_rows), np.arange(block_cols), indexing='ij')
+
+    result = {}
+    if is_stack:
+        result['frame'] = frame_idx.ravel()
+    result['block_row'] = row_idx.ravel()
+    result['block_col'] = col_idx.ravel()
+    result['y'] = row_idx.ravel() * block_shape[0]
+    result['x'] = col_idx.ravel() * block_shape[1]
+
+    if set(metrics) & {"mean", "std", "basic", "photon_flux"}:
+        mean = view.mean(axis=block_axes, dtype=np.float64)
+    if set(metrics) & {"std", "basic"}:
+        mean_square = np.square(view, dtype=np.float64).mean(axis=block_axes)
+        std = np.sqrt(np.maximum(mean_square - mean ** 2, 0))
+    for metric in metrics:
+        if metric == "mean":
+            result[metric] = mean.ravel()
+        if metric == "std":
+            result[metric] = std.ravel()
+        if metric == "basic":
+            result[metric] = (std / mean).ravel()
+        if metric == "photon_flux":
+            result[metric] = np.sqrt(mean).ravel()
+        if metric == "acutance":
+            grady, gradx = np.gradient(view, axis=block_axes)
+            result[metric] = (grady ** 2 + gradx ** 2).mean(axis=block_axes).ravel()
+        if metric == "contrast":
+            i_max, i_min = np.percentile(view, [percentile_max, percentile_min], axis=block_axes)
+            result[metric] = ((i_max-i_min)/(i_max+i_min)).ravel()
+    return pd.DataFrame(result)
@@ -1,7 +1,7 @@
 ## this file has input/output related functions
 ### reading/writing tiff, hdf5s, reading metadata
 
-from typing import Any, Union
+from typing import Any, Iterator, Union
 import tifffile
 import h5py
 import pandas as pd
@@ -171,6 +171,152 @@ def get_movie_shape(filepath : str) -> Tuple:
         movie_shape = motion_corrected_movie_file['data'].shape
     return movie_shape
 
+def _is_h5(path : str) -> bool:
+    """
+    True if path points to a hdf5 file, judging by extension
+    """
+    return os.path.splitext(path)[1].lower() in ['.h5', '.hdf5']
+
+def get_num_frames(path : str, field : str = 'data') -> int:
+    """
+    Get number of frames in a tiff or hdf5 movie without reading pixel data
+    Parameters
+    ----------
+    path : str
+        absolute path to the tiff or hdf5 file
+    field : str, optional
+        dataset with the movie in hdf5 file, by default 'data'
+    Returns
+    -------
+    int
+        number of frames (tiff pages)
+    """
+    if _is_h5(path):
+        with h5py.File(path, 'r') as h5_file:
+            return h5_file[field].shape[0]
+    with tifffile.TiffFile(path, mode ='rb') as tiff:
+        return len(tiff.pages)
+
+def read_frames(path : str, start : int, stop : int, field : str = 'data', num_frames : Union[int, None] = None) -> np.array:
+    """
+    Read range of frames from tiff or hdf5 movie. 
+    Every call opens the file, use iter_chunks to read a whole movie
+    Parameters
+    ----------
+    path : str
+        absolute path to the tiff or hdf5 file
+    start : int
+        first frame to read
+    stop : int
+        frame to stop at (not read)
+    field : str, optional
+        dataset with the movie in hdf5 file, by default 'data'
+    num_frames : Union[int, None], optional
+        number of frames in the movie if known (get_num_frames), saves counting tiff pages, 
+        which reads every page header, by default None
+    Returns
+    -------
+    np.array
+        3D numpy array with frames
+    """
+    if _is_h5(path):
+        with h5py.File(path, 'r') as h5_file:
+            return h5_file[field][start:stop]
+    with tifffile.TiffFile(path, mode ='rb') as tiff:
+        stop = min(stop, len(tiff.pages) if num_frames is None else num_frames)
+        return tiff.asarray(key=range(start, stop)).reshape(stop-start, *tiff.pages[0].shape)
+
+def iter_chunks(path : str, chunk_size : int = 500, field : str = 'data', start : int = 0, stop : Union[int, None] = None) -> Iterator[np.array]:
+    """
+    Iterate over a tiff or hdf5 movie in chunks of frames, keeping only one chunk in memory
+    Parameters
+    ----------
+    path : str
+        absolute path to the tiff or hdf5 file
+    chunk_size : int, optional
+        number of frames in a chunk, by default 500
+    field : str, optional
+        dataset with the movie in hdf5 file, by default 'data'
+    start : int, optional
+        first frame to read, by default 0
+    stop : Union[int, None], optional
+        frame to stop at, by default None - read to the end
+    Yields
+    ------
+    np.array
+        3D numpy array with chunk_size frames (fewer in the last chunk)
+    """
+    if _is_h5(path):
+        with h5py.File(path, 'r') as h5_file:
+            dataset = h5_file[field]
+            stop = dataset.shape[0] if stop is None else min(stop, dataset.shape[0])
+            for chunk_start in range(start, stop, chunk_size):
+                yield dataset[chunk_start:min(chunk_start+chunk_size, stop)]
+    else:
+        with tifffile.TiffFile(path, mode ='rb') as tiff:
+            num_pages = len(tiff.pages)
+            page_shape = tiff.pages[0].shape
+            stop = num_pages if stop is None else min(stop, num_pages)
+            for chunk_start in range(start, stop, chunk_size):
+                chunk_stop = min(chunk_start+chunk_size, stop)
+                yield tiff.asarray(key=range(chunk_start, chunk_stop)).reshape(chunk_stop-chunk_start, *page_shape)
+
+class StackWriter():
+    """
+    Writes a movie to tiff or hdf5 file chunk by chunk, so it never has to be in memory as a whole.
+    Use as a context manager:
+        with StackWriter(path, shape, dtype) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+    """
+    def __init__(self, path : str, shape : Union[tuple, None] = None, dtype : Any = None, field : str = 'data'):
+        """
+        Parameters
+        ----------
+        path : str
+            file to write, hdf5 if extension is .h5 or .hdf5, bigtiff otherwise
+        shape : Union[tuple, None], optional
+            full shape of the movie, required for hdf5, by default None
+        dtype : Any, optional
+            data type of the movie, required for hdf5, by default None
+        field : str, optional
+            dataset to create in hdf5 file, by default 'data'
+        """
+        self.path = path
+        self.shape = shape
+        self.dtype = dtype
+        self.field = field
+        self.position = 0
+        self._file = None
+        self._dataset = None
+
+    def __enter__(self):
+        if _is_h5(self.path):
+            assert self.shape is not None and self.dtype is not None, "shape and dtype are needed to write hdf5"
+            self._file = h5py.File(self.path, 'w')
+            self._dataset = self._file.create_dataset(self.field, shape=self.shape, dtype=self.dtype,
+                                                      chunks=(1,) + tuple(self.shape[1:]))
+        else:
+            self._file = tifffile.TiffWriter(self.path, bigtiff=True)
+        return self
+
+    def write(self, chunk : np.array) -> None:
+        """
+        Append frames to the file
+        Parameters
+        ----------
+        chunk : np.array
+            3D numpy array with frames to append
+        """
+        if self._dataset is not None:
+            self._dataset[self.position:self.position+len(chunk)] = chunk
+        else:
+            self._file.write(chunk, contiguous=True, photometric='minisblack')
+        self.position += len(chunk)
+
+    def __exit__(self, *exc_info):
+        self._file.close()
+
 def read_scanimage_stack_metadata(metadata : dict) -> dict:
     """
     read_scanimage_stack_metadata read only metadata relevant for a stack
@@ -572,13 +718,13 @@ class LimsApi():
         mouse_id = line.split('-')[-1]
         return (cre, mouse_id)
     
-    def get_fullfield_raw_path(self, sessions_id: int) -> str or None:
+    def get_fullfield_raw_path(self, session_id: int) -> str or None:
         """
         get_fullfile_raw_path returns filepath in windwos format to the raw tiff file containing unstitched fullfield stack
 
         Parameters
         ----------
-        sessions_id : int
+        session_id : int
             LIMS sessions ID
 
         Returns
@@ -593,10 +739,11 @@ class LimsApi():
                 FROM ophys_sessions os
                 WHERE os.id = '{session_id}'"""
         #get sessions directory in lims
-        session_directory = pd.read_sql(query, lapi.lims_db.get_connection())['storage_directory'].values[0]
+        session_directory = pd.read_sql(query, self.lims_db.get_connection())['storage_directory'].values[0]
         #reformat filepath for windwos:
-        session_directory = session_directory.replace('/', '\\')
-        session_directory = session_directory.replace('\\allen', '\\\\allen')
+        if os.name == 'nt':
+            session_directory = session_directory.replace('/', '\\')
+            session_directory = session_directory.replace('\\allen', '\\\\allen')
         #get all files in sessions dir
         files = os.listdir(session_directory)
         #find file for fullfield stack
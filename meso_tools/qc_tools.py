@@ -0,0 +1,123 @@
+## this file has functions to run imaging quality metrics over many experiments
+### streaming reads of each movie, process pool over experiments, parquet checkpoints
+
+from typing import Union
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+import time
+import pandas as pd
+from meso_tools.image_tools import compute_temporal_stats, compute_basic_snr, compute_photon_flux, compute_block_snr
+
+
+def compute_movie_qc(movie_path : str, block_shape : tuple = (32, 32), blocks_to_agg : tuple = (6, 10), chunk_size : int = 500, field : str = 'data') -> dict:
+    """
+    Compute quality metrics of one movie reading it once, in chunks: 
+    temporal variance from the streamed statistics, basic SNR, photon flux and block SNR of the mean image
+
+    Parameters
+    ----------
+    movie_path : str
+        path to tiff or hdf5 movie (e.g. motion corrected movie)
+    block_shape : tuple, optional
+        Shape of blocks for compute_block_snr, by default (32, 32)
+    blocks_to_agg : tuple, optional
+        Start and end index of blocks to aggregate in compute_block_snr, by default (6, 10)
+    chunk_size : int, optional
+        number of frames read at once, by default 500
+    field : str, optional
+        dataset with the movie in hdf5 files, by default 'data'
+
+    Returns
+    -------
+    dict
+        num_frames, mean_intensity, temporal_variance, basic_snr, photon_flux, block_snr
+    """
+    stats = compute_temporal_stats(movie_path, chunk_size, field=field)
+    mean_image = stats.mean
+    # crop mean image to a whole number of blocks
+    rows = mean_image.shape[0] - mean_image.shape[0] % block_shape[0]
+    cols = mean_image.shape[1] - mean_image.shape[1] % block_shape[1]
+    return {'num_frames': stats.n,
+            'mean_intensity': float(stats.frame_means.mean()),
+            'temporal_variance': float(stats.variance.mean()),
+            'basic_snr': float(compute_basic_snr(mean_image)),
+            'photon_flux': float(compute_photon_flux(mean_image)),
+            'block_snr': float(compute_block_snr(mean_image[:rows, :cols], block_shape, blocks_to_agg))}
+
+
+def _run_experiment_qc(key : str, movie_path : str, checkpoint_path : str, qc_kwargs : dict) -> pd.DataFrame:
+    """
+    Worker: compute QC of one movie and write it to its checkpoint parquet file
+    """
+    start = time.time()
+    qc = compute_movie_qc(movie_path, **qc_kwargs)
+    result = pd.DataFrame([{'key': key, 'movie_path': movie_path, **qc, 'runtime_s': time.time() - start}])
+    result.to_parquet(checkpoint_path)
+    return result
+
+
+def run_batch_qc(experiments : Union[list, pd.DataFrame], output_dir : str, lims_api : object = None, n_workers : Union[int, None] = None, **qc_kwargs) -> pd.DataFrame:
+    """
+    Compute QC metrics (see compute_movie_qc) of many movies in a process pool.
+    Each experiment's result is written to its own parquet file in output_dir as soon as it's done, 
+    experiments that already have one are skipped, so reruns only compute what is missing.
+    All results are collected into output_dir/qc_results.parquet. Needs pyarrow (or fastparquet).
+
+    Parameters
+    ----------
+    experiments : Union[list, pd.DataFrame]
+        list of movie paths with unique file names (names are the keys), 
+        or dataframe with exp_id column (e.g. from LimsApi.get_experiments_in_project)
+    output_dir : str
+        folder for checkpoints and the combined table, created if it does not exist
+    lims_api : object, optional
+        LimsApi instance to resolve motion corrected movies of experiments in a dataframe, by default None
+    n_workers : Union[int, None], optional
+        number of processes, by default number of cores
+    qc_kwargs :
+        block_shape, blocks_to_agg, chunk_size, field passed to compute_movie_qc
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per experiment with its metrics; experiments that failed have an error message instead
+    """
+    if isinstance(experiments, pd.DataFrame):
+        assert lims_api is not None, "LimsApi instance is needed to find movies of experiments"
+        exp_ids = experiments['exp_id'].drop_duplicates()
+        movies = {str(exp_id): lims_api.get_motion_corrected_stack(exp_id) for exp_id in exp_ids}
+    else:
+        experiments = list(dict.fromkeys(experiments))
+        keys = [os.path.splitext(os.path.basename(path))[0] for path in experiments]
+        # keys name checkpoint files, two movies with the same file name would share one
+        duplicates = sorted(key for key, count in Counter(keys).items() if count > 1)
+        assert not duplicates, f"Movies with the same file name, pass a dataframe or rename them: {duplicates}"
+        movies = dict(zip(keys, experiments))
+
+    os.makedirs(output_dir, exist_ok=True)
+    results = []
+    errors = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {}
+        for key, movie_path in movies.items():
+            checkpoint_path = os.path.join(output_dir, f"{key}.parquet")
+            if os.path.isfile(checkpoint_path):
+                results.append(pd.read_parquet(checkpoint_path))
+            elif movie_path is None:
+                errors.append({'key': key, 'movie_path': None, 'error': 'movie not found'})
+            else:
+                futures[executor.submit(_run_experiment_qc, key, movie_path, checkpoint_path, qc_kwargs)] = (key, movie_path)
+        for future in as_completed(futures):
+            key, movie_path = futures[future]
+            try:
+                results.append(future.result())
+            except Exception as error:
+                print(f"QC failed for {key}: {error}")
+                errors.append({'key': key, 'movie_path': movie_path, 'error': repr(error)})
+
+    qc_table = pd.concat(results + [pd.DataFrame(errors)], ignore_index=True) if results or errors else pd.DataFrame()
+    if len(qc_table):
+        qc_table = qc_table.sort_values('key', ignore_index=True)
+        qc_table.to_parquet(os.path.join(output_dir, 'qc_results.parquet'))
+    return qc_table
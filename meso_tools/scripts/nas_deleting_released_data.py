@@ -6,8 +6,10 @@
 #  - read folder structure in specified NASs
 #  - compare what's on NAS to what's been released
 #  - delete all backups of released data  
+# both NAS devices are cleaned at the same time, progress is kept in a journal file,
+# so if the script is interrupted, re-running it skips what was already deleted
 
-from ..NAS_tools import NASapi
+from ..NAS_tools import NASapi, run_cleanup
 import pandas as pd
 
 # sessions to delete
@@ -20,6 +22,9 @@ csv2 = r""
 cred = r""
 cred2 = r""
 
+# cleanup journal, keep the same file to resume an interrupted run
+journal_path = r""
+
 # pull session list
 df1 = pd.read_csv(csv1)
 df2 = pd.read_csv(csv2)
@@ -28,19 +33,10 @@ session_list.extend(df1.ophys_session_id.astype(str).to_list())
 session_list.extend(df2.ophys_session_id.astype(str).to_list())
 
 # code below will delete
-api = NASapi(cred)
-folders = api.nas_folders()
-
-for folder in folders:
-    check = api.nas_query(folder)
-    check2 = api.release_check(session_list, check)
-    for item in check2:
-        api.nas_delete(item)
-
-api = NASapi(cred2)
-folders = api.nas_folders()
-for folder in folders:
-    check = api.nas_query(folder)
-    check2 = api.release_check(session_list, check)
-    for item in check2:
-        api.nas_delete(item)
\ No newline at end of file
+apis = [NASapi(cred), NASapi(cred2)]
+results = run_cleanup(apis, session_list, journal_path)
+print(results)
+if any(result['unfinished'] for result in results.values()):
+    print('some deletions did not finish, run the script again to resume')
+for api in apis:
+    api.nas_logout()
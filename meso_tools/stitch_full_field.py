@@ -22,11 +22,21 @@
 #       figure out insert coordinates
 #           normalization w regards to full field is problematic 
 
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Iterable, Iterator, Tuple, Union
 import numpy as np
+import pandas as pd
+import tifffile
+from meso_tools.hash_utils import HashCache, hash_file_cached
 from meso_tools.io_utils import read_scanimage_metadata as get_meta
-from meso_tools.io_utils import read_tiff, write_tiff
+from meso_tools.io_utils import read_tiff
 from meso_tools.image_tools import image_negative_rescale, image_downsample
-import sciris as sc
 
 
 def read_full_field_stack_meta(metadata : dict) -> dict:
@@ -139,13 +149,57 @@ def check_tiff(tiff_array, meta_dict):
         tiff_shape = np.shape(tiff_array)
 
     rois_num = len(meta_dict['rois'])
-    gap = (raw_len - pix_res_y*rois_num)/(rois_num-1)
+    gap = (raw_len - pix_res_y*rois_num)/(rois_num-1) if rois_num > 1 else raw_len - pix_res_y
     expected_tiff_shape = [num_slices*num_repeats, pix_res_y*len(rois)+(gap*(len(rois)-1)), pix_res_x]
 
     assert expected_tiff_shape == list(tiff_shape), f"Input tiff shape is unexpected"
 
     return output_tiff_shape, int(gap)
 
+def validate_tiff(path_to_tiff : str, meta_dict : dict) -> Tuple[list, int]:
+    """
+    validate_tiff : check a raw full field tiff against its metadata reading only the tiff's IFDs (no image data):
+    page count, shape and dtype of every page, a whole non-negative gap between ROIs, and that the last page's data is inside the file
+    (catches truncated copies). Use it instead of check_tiff to reject bad files before reading them.
+
+    Parameters
+    ----------
+    path_to_tiff : str
+        path to raw full field tiff
+    meta_dict : dict
+        dictionary with stack metadata, after check_meta
+
+    Returns
+    -------
+    Tuple[list, int]
+        output tiff shape [columns, rows] and gap in pixels, same as check_tiff
+    """
+    rois = meta_dict['rois']
+    pix_res_x = rois[0]['scanfields']['pixelResolutionXY'][0]
+    pix_res_y = rois[0]['scanfields']['pixelResolutionXY'][1]
+    rois_num = len(rois)
+    expected_pages = meta_dict['num_slices'] * meta_dict['num_volumes'] * meta_dict['frames_per_slice']
+
+    with tifffile.TiffFile(path_to_tiff, mode ='rb') as tiff:
+        num_pages = len(tiff.pages)
+        assert num_pages == expected_pages, f"Input tiff has {num_pages} pages, metadata expects {expected_pages}"
+        first_page = tiff.pages[0]
+        for page_num, page in enumerate(tiff.pages):
+            assert page.shape == first_page.shape and page.dtype == first_page.dtype, \
+                f"Input tiff page {page_num} is {page.shape} {page.dtype}, page 0 is {first_page.shape} {first_page.dtype}"
+        last_page = tiff.pages[num_pages - 1]
+        assert np.issubdtype(first_page.dtype, np.integer), f"Input tiff has unexpected type {first_page.dtype}"
+        data_end = max(offset + count for offset, count in zip(last_page.dataoffsets, last_page.databytecounts))
+        assert data_end <= tiff.filehandle.size, "Input tiff is truncated"
+        raw_len, raw_width = first_page.shape
+
+    assert raw_width == pix_res_x, f"Input tiff pages are {raw_width} pixels wide, ROIs are {pix_res_x}"
+    gap = (raw_len - pix_res_y*rois_num)/(rois_num-1) if rois_num > 1 else raw_len - pix_res_y
+    assert gap >= 0 and gap == int(gap), f"Input tiff pages have {raw_len} rows, can't fit {rois_num} ROIs of {pix_res_y} rows"
+
+    output_tiff_shape =  [pix_res_x*rois_num, pix_res_y]
+    return output_tiff_shape, int(gap)
+
 def get_output_shape(stack : np.array, meta_dict : dict) -> int:
     """
     get_output_shape : calculate output shape and gap between images inserted vertically in one page of a tiff
@@ -167,35 +221,91 @@ def get_output_shape(stack : np.array, meta_dict : dict) -> int:
     pix_res_x = rois[0]['scanfields']['pixelResolutionXY'][0]
     pix_res_y = rois[0]['scanfields']['pixelResolutionXY'][1]
     rois_num = len(meta_dict['rois'])
-    gap = int((raw_len - pix_res_y*rois_num)/(rois_num-1))
+    gap = int((raw_len - pix_res_y*rois_num)/(rois_num-1)) if rois_num > 1 else raw_len - pix_res_y
 
     output_shape =  [pix_res_x*len(rois), pix_res_y]
 
     return gap, output_shape
 
+def _iter_pages(stack : Union[np.array, str]) -> Iterator[np.array]:
+    """
+    yield 2D pages of a tiff file one at a time, or of a loaded stack ([pages, rows, columns] or [pages, frames, rows, columns]) in page order
+    """
+    if isinstance(stack, str):
+        with tifffile.TiffFile(stack, mode ='rb') as tiff:
+            for page in tiff.pages:
+                yield page.asarray()
+    else:
+        yield from stack.reshape((-1,) + stack.shape[-2:])
+
+def average_pages(stack : Union[np.array, str], meta : dict, avg_slices : bool = True, avg_repeats : bool = True, 
+                  avg_frames : bool = True, robust_groups : int = None) -> np.array:
+    """
+    average_pages : average a ScanImage stack over any combination of repeats (volumes), z slices and frames per slice,
+    reading pages once in file order - page = (volume * num_slices + slice) * frames_per_slice + frame - 
+    and adding each into a float32 accumulator of the output, so memory is the size of the output (one volume 
+    when averaging repeats), not of the stack.
+
+    Parameters
+    ----------
+    stack : Union[np.array, str]
+        path to the raw tiff (read page by page), or loaded stack
+    meta : dict
+        dictionary with stack metadata: num_slices, num_volumes, frames_per_slice
+    avg_slices : bool, optional
+        whether to average over slices, by default True
+    avg_repeats : bool, optional
+        whether to average over repeats, by default True
+    avg_frames : bool, optional
+        whether to average over frames acquired at the same plane, by default True
+    robust_groups : int, optional
+        median of means: split repeats into this many groups, average each group and take the median 
+        of group averages, robust to a few bad repeats (e.g. motion). Needs avg_repeats. By default None (plain mean)
+
+    Returns
+    -------
+    np.array
+        float32 array [repeats, slices, frames, rows, columns] without the averaged axes
+    """
+    num_slices = meta['num_slices']
+    num_volumes = meta['num_volumes']
+    frames = meta['frames_per_slice']
+    keep = (not avg_repeats, not avg_slices, not avg_frames)
+    sizes = (num_volumes, num_slices, frames)
+    groups = 1 if robust_groups is None else robust_groups
+    assert groups == 1 or (avg_repeats and groups <= num_volumes), f"median of means needs averaging over at least {groups} repeats"
+
+    out_axes = tuple(size if kept else 1 for size, kept in zip(sizes, keep))
+    counts = np.zeros((groups,) + out_axes, dtype=np.float32)
+    accumulator = None
+    num_pages = 0
+    for page_num, page in enumerate(_iter_pages(stack)):
+        volume, page_in_volume = divmod(page_num, num_slices * frames)
+        slice_num, frame = divmod(page_in_volume, frames)
+        index = (volume * groups // num_volumes,) + tuple(i if kept else 0 for i, kept in zip((volume, slice_num, frame), keep))
+        if accumulator is None:
+            accumulator = np.zeros(counts.shape + page.shape, dtype=np.float32)
+        accumulator[index] += page
+        counts[index] += 1
+        num_pages += 1
+    assert num_pages == num_volumes * num_slices * frames, f"Stack has {num_pages} pages, metadata expects {num_volumes * num_slices * frames}"
+
+    averaged = accumulator / counts[..., np.newaxis, np.newaxis]
+    averaged = np.median(averaged, axis=0).astype(np.float32) if groups > 1 else averaged[0]
+    out_shape = [size for size, kept in zip(sizes, keep) if kept] + list(averaged.shape[-2:])
+    return averaged.reshape(out_shape)
+
 def average_tiff(tiff_array, meta):
     """
     average input tiff over all slices and number of stack repeats (volumes) and frames per plane 
     return : a single page tiff (2D np.array)
     """
-    slices = meta['num_volumes'] # number of z slices
-    # let's average over repeats and slices
-    # resahpe tp get array of [slices, repeats, y_pix_size, x_pix_size]
-    x = tiff_array.reshape(tiff_array.shape[0] // slices, slices, tiff_array.shape[1], tiff_array.shape[2]) 
-    # average over slices:
-    y = x.mean(axis = 0) 
-    # average over repeats:
-    repeats = meta['num_volumes'] # this is number of repeats we want to average
-    if repeats > 1 : 
-        averaged_tiff = y.mean(axis=0)
-    else:
-        averaged_tiff = y
-    return averaged_tiff
+    return average_pages(tiff_array, meta)
 
 def average_stack(stack: np.array, meta: dict, avg_slices : bool = True, avg_repeats : bool = True, avg_frames : bool = True) -> np.array:
     """
     average_stack average stack over repeats of stack, planes or frames per plane
-    Scanimage tiff files are ordered the following way : [number of z slices * number of stack repeats, frames per plane, rows, columns]
+    Scanimage tiff files are ordered the following way : [number of stack repeats * number of z slices, frames per plane, rows, columns]
     Parameters
     ----------
     stack : np.array
@@ -212,43 +322,31 @@ def average_stack(stack: np.array, meta: dict, avg_slices : bool = True, avg_rep
     Returns
     -------
     np.array
-        averaged stack
+        averaged stack, see average_pages
     """
-    repeats = meta['num_volumes'] # number of repeats of one stack
-    frames = meta['frames_per_slice'] # number of frames aquired at one z
-
-    # let's first average by frames
-    if avg_frames & (frames !=1):
-        stack = stack.mean(axis=1)
+    return average_pages(stack, meta, avg_slices, avg_repeats, avg_frames)
 
-    # reshape to average repeats and slices
-    stack_reshape = stack.reshape(stack.shape[0] // repeats, repeats, stack.shape[1], stack.shape[2])
-    # avergae repeats
-    if avg_repeats:
-        stack_averaged = stack_reshape.mean(axis = 1)
-    # avergae slices
-    if avg_slices:
-        stack_averaged = stack_reshape.mean(axis = 0)
-    # average both  
-    if avg_slices & avg_repeats:
-        stack_temp = stack_reshape.mean(axis = 1)
-        stack_averaged = stack_temp.mean(axis = 0)
 
-    return stack_averaged
+def get_stitch_boxes(meta_dict : dict, gap : int) -> dict:
+    """
+    get_stitch_boxes : compute where each ROI is cut from a raw page and where it's inserted into the stitched image
 
+    Parameters
+    ----------
+    meta_dict : dict
+        dictionary with metadata, after check_meta
+    gap : int
+        gap in number of pixels between ROIs in a raw page
 
-def stitch_tiff(averaged_tiff, meta_dict, gap, output_tiff_shape):
-    """
-    actually stitch the file into a full FOV image
-    returns: stitched image, 2D mumpy array
+    Returns
+    -------
+    dict
+        cut_top_right, cut_bottom_left, insert_top_right, insert_bottom_left : [rois, 2] arrays of [row, column] corners,
+        output_shape : [rows, columns] of the stitched image, 
+        min_x, min_y : top right corner of the stitched image, degrees
     """
-
     rois = meta_dict['rois']
 
-    output_tiff_shape = [output_tiff_shape[1],output_tiff_shape[0]]
-
-    stitched_tiff = np.empty(output_tiff_shape)
-
     pix_to_deg_x = rois[0]['scanfields']['pixelResolutionXY'][0]/rois[0]['scanfields']['sizeXY'][0]
     pix_to_deg_y = rois[0]['scanfields']['pixelResolutionXY'][1]/rois[0]['scanfields']['sizeXY'][1]
 
@@ -263,8 +361,6 @@ def stitch_tiff(averaged_tiff, meta_dict, gap, output_tiff_shape):
     roi_x_min = np.min([i[0] for i in insert_top_right])
     roi_y_min = np.min([i[1] for i in insert_top_right])
     insert_top_right -= [roi_x_min, roi_y_min]
-    meta_dict['min_x'] = roi_x_min
-    meta_dict['min_y'] = roi_y_min
     
     #normalize bottom left corner coords, degrees
     insert_bottom_left -= [roi_x_min, roi_y_min]
@@ -288,13 +384,318 @@ def stitch_tiff(averaged_tiff, meta_dict, gap, output_tiff_shape):
     cut_top_right = np.array([[i*(roi_sizes[i][1] + gap), 0] for i, roi in enumerate(rois)])
     cut_bottom_left = np.array([[(i+1)*(roi_sizes[i][1]) + i*gap, roi_sizes[i][0]] for i, roi in enumerate(rois)])
 
-    for i, _ in enumerate(rois):
-        # averaged_tiff = image_negative_rescale(averaged_tiff)
-        image_to_insert = averaged_tiff[cut_top_right[i][0]:cut_bottom_left[i][0], cut_top_right[i][1]:cut_bottom_left[i][1]]
-        stitched_tiff[insert_top_right[i][0]:insert_bottom_left[i][0], insert_top_right[i][1]:insert_bottom_left[i][1]] = image_to_insert
+    pix_res_x = rois[0]['scanfields']['pixelResolutionXY'][0]
+    pix_res_y = rois[0]['scanfields']['pixelResolutionXY'][1]
+
+    return {'cut_top_right': cut_top_right, 'cut_bottom_left': cut_bottom_left,
+            'insert_top_right': insert_top_right, 'insert_bottom_left': insert_bottom_left,
+            'output_shape': [pix_res_y, pix_res_x*len(rois)], 'min_x': roi_x_min, 'min_y': roi_y_min}
+
+class StitchPlan:
+    """
+    StitchPlan : ROI cut/insert geometry of a full field stack, computed once and applied to any number of planes.
+
+    Parameters
+    ----------
+    meta_dict : dict
+        dictionary with metadata, after check_meta
+    gap : int
+        gap in number of pixels between ROIs in a raw page (get_output_shape, get_gap)
+    """
+    def __init__(self, meta_dict : dict, gap : int):
+        boxes = get_stitch_boxes(meta_dict, gap)
+        self.gap = gap
+        self.output_shape = tuple(int(i) for i in boxes['output_shape']) # rows, columns
+        self.min_x = boxes['min_x']
+        self.min_y = boxes['min_y']
+        self.cuts = [(slice(int(top[0]), int(bottom[0])), slice(int(top[1]), int(bottom[1])))
+                     for top, bottom in zip(boxes['cut_top_right'], boxes['cut_bottom_left'])]
+        self.inserts = [(slice(int(top[0]), int(bottom[0])), slice(int(top[1]), int(bottom[1])))
+                        for top, bottom in zip(boxes['insert_top_right'], boxes['insert_bottom_left'])]
+        self.raw_shape = (int(boxes['cut_bottom_left'][:, 0].max()), int(boxes['cut_bottom_left'][:, 1].max()))
+
+    def _check_input(self, stack : np.array):
+        assert stack.shape[-2] >= self.raw_shape[0] and stack.shape[-1] >= self.raw_shape[1], \
+            f"Input of shape {stack.shape[-2:]} is smaller than ROIs need: {self.raw_shape}"
+
+    def apply(self, stack : np.array, out : np.array = None) -> np.array:
+        """
+        apply : stitch a raw page or a stack of raw pages, [..., rows, columns], 
+        one copy per ROI covers all leading axes (z planes, frames) at once.
+
+        Parameters
+        ----------
+        stack : np.array
+            raw page(s)
+        out : np.array, optional
+            array of shape [..., *output_shape] to write into, pixels outside ROIs are left as they are;
+            by default a zero array of stack's dtype
+
+        Returns
+        -------
+        np.array
+            stitched page(s)
+        """
+        self._check_input(stack)
+        if out is None:
+            out = np.zeros(stack.shape[:-2] + self.output_shape, dtype=stack.dtype)
+        for cut, insert in zip(self.cuts, self.inserts):
+            out[(Ellipsis,) + insert] = stack[(Ellipsis,) + cut]
+        return out
+
+def stitch_tiff(averaged_tiff, meta_dict, gap, output_tiff_shape, plan = None):
+    """
+    actually stitch the file into a full FOV image
+    averaged_tiff can be a single page or a [z, rows, columns] stack, 
+    pass a StitchPlan to reuse geometry between calls
+    returns: stitched image, mumpy array
+    """
+    if plan is None:
+        plan = StitchPlan(meta_dict, gap)
+    meta_dict['min_x'] = plan.min_x
+    meta_dict['min_y'] = plan.min_y
+
+    output_tiff_shape = [output_tiff_shape[1],output_tiff_shape[0]]
+
+    stitched_tiff = np.zeros(list(np.shape(averaged_tiff)[:-2]) + output_tiff_shape)
+    plan.apply(averaged_tiff, out=stitched_tiff)
 
     return stitched_tiff, meta_dict
 
+def stitch_stack_parallel(stack : Union[np.array, str], plan : StitchPlan, out : Union[np.array, str] = None, 
+                          n_workers : int = None, planes_per_task : int = 8) -> np.array:
+    """
+    stitch_stack_parallel : stitch a [z, rows, columns] stack with a pool of threads, 
+    one task per (block of planes, ROI). Every task copies straight from the input into its own 
+    non-overlapping region of one shared output array, so image data is never pickled or copied between workers;
+    numpy releases the GIL for the copies, so threads scale with cores.
+
+    Parameters
+    ----------
+    stack : Union[np.array, str]
+        raw stack, or path to an uncompressed raw tiff (memory mapped read-only)
+    plan : StitchPlan
+        stitching geometry
+    out : Union[np.array, str], optional
+        array of shape [z, *plan.output_shape] to write into, or path of a tiff to create as a memory map, 
+        by default a new zero array
+    n_workers : int, optional
+        number of threads, by default os.cpu_count()
+    planes_per_task : int, optional
+        number of planes copied by one task, by default 8
+
+    Returns
+    -------
+    np.array
+        stitched stack (memory map if out is a path)
+    """
+    if isinstance(stack, str):
+        stack = tifffile.memmap(stack, mode='r')
+    if stack.ndim == 2:
+        stack = stack[np.newaxis]
+    plan._check_input(stack)
+    out_shape = (stack.shape[0],) + plan.output_shape
+    if out is None:
+        out = np.zeros(out_shape, dtype=stack.dtype)
+    elif isinstance(out, str):
+        out = tifffile.memmap(out, shape=out_shape, dtype=stack.dtype, photometric='minisblack', bigtiff=True)
+    assert out.shape == out_shape, f"Output of shape {out.shape} doesn't match stitched shape {out_shape}"
+
+    def copy_roi(task):
+        planes, roi = task
+        out[(planes,) + plan.inserts[roi]] = stack[(planes,) + plan.cuts[roi]]
+
+    tasks = [(slice(start, start + planes_per_task), roi) 
+             for start in range(0, stack.shape[0], planes_per_task) for roi in range(len(plan.cuts))]
+    with ThreadPoolExecutor(max_workers=n_workers or os.cpu_count()) as executor:
+        # list() re-raises the first exception from workers
+        list(executor.map(copy_roi, tasks))
+
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+def get_gap(raw_len : int, meta_dict : dict) -> int:
+    """
+    get_gap : gap in number of pixels between ROIs stacked vertically in one raw page
+
+    Parameters
+    ----------
+    raw_len : int
+        number of rows in a raw page
+    meta_dict : dict
+        dictionary with metadata
+
+    Returns
+    -------
+    int
+        gap in number of pixels
+    """
+    rois = meta_dict['rois']
+    pix_res_y = rois[0]['scanfields']['pixelResolutionXY'][1]
+    rois_num = len(rois)
+    if rois_num == 1:
+        # nothing to separate, rows below the single ROI (if any) count as gap, as in validate_tiff
+        return raw_len - pix_res_y
+    return int((raw_len - pix_res_y*rois_num)/(rois_num-1))
+
+def get_slice_pages(meta_dict : dict, slice_num : int) -> np.array:
+    """
+    get_slice_pages : indices of all pages acquired at one z slice (all repeats and frames).
+    ScanImage writes pages volume by volume, slice by slice, frame by frame: 
+    page = (volume * num_slices + slice) * frames_per_slice + frame
+
+    Parameters
+    ----------
+    meta_dict : dict
+        dictionary with stack metadata (num_slices, num_volumes, frames_per_slice)
+    slice_num : int
+        z slice
+
+    Returns
+    -------
+    np.array
+        page indices, in file order
+    """
+    num_slices = meta_dict['num_slices']
+    frames = meta_dict['frames_per_slice']
+    volumes = np.arange(meta_dict['num_volumes'])
+    first_pages = (volumes * num_slices + slice_num) * frames
+    return (first_pages[:, np.newaxis] + np.arange(frames)).ravel()
+
+def stitch_tiff_streaming(path_to_tiff : str, path_to_output : str, meta_dict : dict, average_slices : bool = False, 
+                          pyramid : bool = False) -> Tuple[list, dict]:
+    """
+    stitch_tiff_streaming : average and stitch a raw full field tiff reading one page at a time.
+    Pages are read once, in file order, and each is added to a float32 running sum of its slice (one sum for all 
+    slices if average_slices), so the file is read sequentially; sums are then divided by their number of pages, 
+    stitched (StitchPlan.apply, same as stitch_tiff) and written to path_to_output one plane at a time. 
+    Memory holds one input page, one page-shaped sum per output plane and one stitched plane however many pages the tiff has.
+
+    Parameters
+    ----------
+    path_to_tiff : str
+        path to raw full field tiff
+    path_to_output : str
+        path to the stitched tiff to write
+    meta_dict : dict
+        dictionary with stack metadata, after check_meta
+    average_slices : bool, optional
+        if True, average all slices into one plane (as average_tiff), 
+        if False - write one plane per z slice averaged over repeats and frames, by default False
+    pyramid : bool, optional
+        if True, write a tiled multi-resolution OME-TIFF (see write_pyramid_tiff), by default False (flat tiff)
+
+    Returns
+    -------
+    Tuple[list, dict]
+        [rows, columns] of a stitched plane, and meta_dict with min_x, min_y added (needed by insert_surface_to_ff)
+    """
+    num_slices = meta_dict['num_slices']
+    num_groups = 1 if average_slices else num_slices
+    # output plane of every page, pages are ordered as in get_slice_pages
+    num_pages = num_slices * meta_dict['num_volumes'] * meta_dict['frames_per_slice']
+    page_group = (np.arange(num_pages) // meta_dict['frames_per_slice']) % num_groups
+    group_counts = np.bincount(page_group, minlength=num_groups)
+
+    with tifffile.TiffFile(path_to_tiff, mode ='rb') as tiff:
+        plan = StitchPlan(meta_dict, get_gap(tiff.pages[0].shape[0], meta_dict))
+        meta_dict['min_x'] = plan.min_x
+        meta_dict['min_y'] = plan.min_y
+
+        page_sums = np.zeros((num_groups,) + tiff.pages[0].shape, dtype=np.float32)
+        for page_num, page in enumerate(tiff.pages):
+            if page_num == num_pages:
+                break
+            page_sums[page_group[page_num]] += page.asarray()
+        page_sums /= group_counts.reshape(-1, 1, 1)
+
+        def stitched_planes():
+            stitched_plane = np.zeros(plan.output_shape, dtype=np.float32)
+            for page_sum in page_sums:
+                yield plan.apply(page_sum, out=stitched_plane)
+
+        if pyramid:
+            shape = plan.output_shape if average_slices else (num_groups,) + plan.output_shape
+            _write_pyramid(path_to_output, stitched_planes(), shape, np.float32)
+        else:
+            with tifffile.TiffWriter(path_to_output, bigtiff=True) as writer:
+                for plane in stitched_planes():
+                    writer.write(plane, contiguous=True, photometric='minisblack')
+
+    return list(plan.output_shape), meta_dict
+
+def _pyramid_tiles(planes : Iterable[np.array], tile : tuple, factor : int, reduced : Union[list, None]) -> Iterator[np.array]:
+    """
+    yield tiles of planes one plane at a time; if reduced is a list, each plane downsampled by factor is appended to it, 
+    so the next level is built from this one
+    """
+    for plane in planes:
+        if reduced is not None:
+            reduced.append(image_downsample(plane, factor))
+        for row in range(0, plane.shape[0], tile[0]):
+            for col in range(0, plane.shape[1], tile[1]):
+                yield plane[row:row+tile[0], col:col+tile[1]]
+
+def _write_pyramid(path : str, planes : Iterable[np.array], shape : tuple, dtype : np.dtype, levels : int = None, factor : int = 2, 
+                   min_size : int = 256, tile : tuple = (256, 256), compression : str = 'zlib') -> int:
+    """
+    write planes of given total shape (2D or [z, rows, columns]) as a pyramid OME-TIFF, see write_pyramid_tiff; 
+    planes can be a generator, full resolution planes are only held one at a time
+    """
+    if levels is None:
+        levels = 0
+        while min(shape[-2:]) // factor**(levels + 1) >= min_size:
+            levels += 1
+
+    options = dict(tile=tile, compression=compression, photometric='minisblack', dtype=dtype)
+    axes = 'YX' if len(shape) == 2 else 'ZYX'
+    with tifffile.TiffWriter(path, bigtiff=True, ome=True) as writer:
+        # all full resolution pages come first, then each level's pages (SubIFDs), 
+        # every level is downsampled once from the previous one while that one is written
+        reduced = [] if levels else None
+        writer.write(_pyramid_tiles(planes, tile, factor, reduced), shape=tuple(shape), subifds=levels, 
+                     metadata={'axes': axes}, **options)
+        for level in range(1, levels + 1):
+            planes, reduced = reduced, ([] if level < levels else None)
+            shape = tuple(shape[:-2]) + planes[0].shape
+            writer.write(_pyramid_tiles(planes, tile, factor, reduced), shape=shape, subfiletype=1, **options)
+    return levels
+
+def write_pyramid_tiff(path : str, image : np.array, levels : int = None, factor : int = 2, min_size : int = 256, 
+                       tile : tuple = (256, 256), compression : str = 'zlib') -> int:
+    """
+    write_pyramid_tiff : write a stitched image or stack as a tiled, compressed, multi-resolution OME-TIFF.
+    Reduced resolutions are stored as SubIFDs of full resolution pages, so viewers read only 
+    the level and tiles they show. Levels are block means (image_downsample), each computed once from the level above 
+    while that one is written; image can be a memory map (e.g. stitch_stack_parallel output), full resolution planes 
+    are read once, one at a time, reduced levels (at most 1/3 of the image size) are kept in memory until written.
+
+    Parameters
+    ----------
+    path : str
+        path to the output tiff, .ome.tif
+    image : np.array
+        2D image or [z, rows, columns] stack
+    levels : int, optional
+        number of reduced resolution levels, by default as many as keep both sides >= min_size
+    factor : int, optional
+        downsampling factor between levels, by default 2
+    min_size : int, optional
+        smallest side of the smallest level when levels is None, by default 256
+    tile : tuple, optional
+        tile shape, multiples of 16, by default (256, 256)
+    compression : str, optional
+        tifffile compression, by default 'zlib'
+
+    Returns
+    -------
+    int
+        number of reduced resolution levels written
+    """
+    planes = image.reshape((-1,) + image.shape[-2:])
+    return _write_pyramid(path, planes, image.shape, image.dtype, levels, factor, min_size, tile, compression)
+
 def split_surface(path_to_surface):
 
     surface_array = read_tiff(path_to_surface)
@@ -353,12 +754,11 @@ def insert_surface_to_ff(ff_stitched_tiff, ff_meta_dict, split_surface_meta):
         convert_factor = pixel_resolution_surf / pixel_resolution_ff # XY = XY * XY
         ff_stitched_mapped = np.copy(ff_stitched_tiff)
 
-        # downsampling 
-        for i, roi in enumerate(split_surface_meta["rois"]):
-            a = roi['array']
-            b = image_negative_rescale(a)
-            c = image_downsample(b, convert_factor)
-            roi['downsampled_array'] = c
+        # downsampling all rois at once, they have the same shape; image_downsample takes factors as (rows, columns) = YX
+        rescaled = np.stack([image_negative_rescale(roi['array']) for roi in split_surface_meta["rois"]])
+        downsampled = image_downsample(rescaled, convert_factor[::-1])
+        for roi, roi_downsampled in zip(split_surface_meta["rois"], downsampled):
+            roi['downsampled_array'] = roi_downsampled
 
         for roi in split_surface_meta["rois"]:
             scanfield = roi['scanfields']
@@ -439,33 +839,303 @@ def insert_surface_to_ff(ff_stitched_tiff, ff_meta_dict, split_surface_meta):
 
     return ff_stitched_mapped
 
-if __name__ == "__main__":
+STITCH_META_VERSION = 1
+
+def _split_arrays(value, key : str, arrays : dict):
+    """
+    replace numpy arrays in nested dicts/lists with references to entries of arrays, numpy scalars with python ones
+    """
+    if isinstance(value, dict):
+        return {name: _split_arrays(item, f"{key}/{name}" if key else str(name), arrays) for name, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_split_arrays(item, f"{key}/{i}", arrays) for i, item in enumerate(value)]
+    if isinstance(value, np.ndarray):
+        arrays[key] = value
+        return {'__array__': key}
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def _join_arrays(value, arrays : Union[dict, None]):
+    """
+    inverse of _split_arrays, references become None when arrays is None
+    """
+    if isinstance(value, dict):
+        if set(value) == {'__array__'}:
+            return None if arrays is None else arrays[value['__array__']]
+        return {name: _join_arrays(item, arrays) for name, item in value.items()}
+    if isinstance(value, list):
+        return [_join_arrays(item, arrays) for item in value]
+    return value
+
+def save_stitch_meta(path : str, meta_dict : dict) -> None:
+    """
+    save_stitch_meta : save stitching metadata (read_full_field_stack_meta / check_meta / stitch output, 
+    or split_surface output) as JSON with scalars and ROI geometry, plus, if there are any arrays 
+    (all_zs, pixel_to_degree, surface images), a .npz file next to it with the same name.
 
-    #Inputs:
-    path_to_tiff = "/Users/nataliaorlova/Code/data/incoming/1180346813_fullfield.tiff"
-    surface_path = "/Users/nataliaorlova/Code/data/incoming/1180346813_averaged_surface.tiff"
+    Parameters
+    ----------
+    path : str
+        path to the json file
+    meta_dict : dict
+        metadata dictionary
+    """
+    arrays = {}
+    meta_json = _split_arrays(meta_dict, '', arrays)
+    arrays_path = os.path.splitext(path)[0] + '.npz'
+    with open(path, 'w') as meta_file:
+        json.dump({'version': STITCH_META_VERSION, 
+                   'arrays': os.path.basename(arrays_path) if arrays else None, 
+                   'meta': meta_json}, meta_file)
+    if arrays:
+        np.savez(arrays_path, **arrays)
+
+def load_stitch_meta(path : str, load_arrays : bool = True) -> dict:
+    """
+    load_stitch_meta : load metadata saved with save_stitch_meta
+
+    Parameters
+    ----------
+    path : str
+        path to the json file
+    load_arrays : bool, optional
+        whether to read arrays from the .npz file, if False they are None - fast when only geometry is needed, by default True
+
+    Returns
+    -------
+    dict
+        metadata dictionary
+    """
+    with open(path) as meta_file:
+        saved = json.load(meta_file)
+    assert saved.get('version', 0) <= STITCH_META_VERSION, f"{path} was saved by a newer version ({saved.get('version')}) of the format"
+    arrays = None
+    if load_arrays and saved['arrays'] is not None:
+        with np.load(os.path.join(os.path.dirname(path), saved['arrays']), allow_pickle=False) as arrays_file:
+            arrays = dict(arrays_file)
+    return _join_arrays(saved['meta'], arrays)
+
+def stitch_session(path_to_tiff : str, output_dir : str, key : str, surface_path : str = None) -> dict:
+    """
+    stitch_session : stitch one full field stack (averaged over slices and repeats) and, if a surface file is given, 
+    map surface images into it
 
+    Parameters
+    ----------
+    path_to_tiff : str
+        path to raw full field tiff
+    output_dir : str
+        folder for outputs
+    key : str
+        prefix of output file names, e.g. session id
+    surface_path : str, optional
+        path to averaged surface tiff, by default None (no mapping)
 
-    #Outputs: 
-    meta_path = "/Users/nataliaorlova/Code/data/incoming/1180346813_fullfield_metadata.dict"
-    path_to_tiff_stitched = "/Users/nataliaorlova/Code/data/incoming/1180346813_fullfield_stitched.tiff"
-    path_to_tiff_mapped = "/Users/nataliaorlova/Code/data/incoming/1180346813_fullfield_stitched_mapped.tiff"
+    Returns
+    -------
+    dict
+        paths to written outputs: meta, stitched and, with a surface, mapped
+    """
+    outputs = get_session_outputs(output_dir, key, surface_path is not None)
 
-    #reading tiff and it's metadata, saving metadata to a dict object to disk
-    tiff_array = read_tiff(path_to_tiff)
     meta = get_meta(path_to_tiff)
-    ff_meta_dict = read_full_field_meta(meta)
+    ff_meta_dict = read_full_field_stack_meta(meta)
     ff_meta_dict = check_meta(ff_meta_dict)
-    check_tiff(tiff_array, ff_meta_dict)
-    output_tiff_shape, gap = check_tiff(tiff_array, ff_meta_dict)
-    sc.saveobj(meta_path, ff_meta_dict)
-
-    #averaging and stitching stack, writing stitched stack in a tiff file to disk
-    ff_averaged_tiff = average_tiff(tiff_array, ff_meta_dict)
-    ff_stitched_tiff, ff_meta_dict = stitch_tiff(ff_averaged_tiff, ff_meta_dict, gap, output_tiff_shape)
-    write_tiff(path_to_tiff_stitched, ff_stitched_tiff)
-
-    #splitting surface file, mapping surface images to full field, saving into a tiff
-    split_surface_meta, surface_averaged = split_surface(surface_path)
-    ff_stitched_mapped = insert_surface_to_ff(ff_stitched_tiff, ff_meta_dict, split_surface_meta)
-    write_tiff(path_to_tiff_mapped, ff_stitched_mapped)
\ No newline at end of file
+    validate_tiff(path_to_tiff, ff_meta_dict)
+
+    _, ff_meta_dict = stitch_tiff_streaming(path_to_tiff, outputs['stitched'], ff_meta_dict, average_slices=True, pyramid=True)
+    save_stitch_meta(outputs['meta'], ff_meta_dict)
+
+    if surface_path is not None:
+        ff_stitched_tiff = read_tiff(outputs['stitched'])
+        split_surface_meta, _ = split_surface(surface_path)
+        ff_stitched_mapped = insert_surface_to_ff(ff_stitched_tiff, ff_meta_dict, split_surface_meta)
+        write_pyramid_tiff(outputs['mapped'], ff_stitched_mapped)
+    return outputs
+
+def get_session_outputs(output_dir : str, key : str, mapped : bool = True) -> dict:
+    """
+    get_session_outputs : paths of files written by stitch_session
+    """
+    outputs = {'meta': os.path.join(output_dir, f"{key}_fullfield_metadata.json"),
+               'stitched': os.path.join(output_dir, f"{key}_fullfield_stitched.ome.tif")}
+    if mapped:
+        outputs['mapped'] = os.path.join(output_dir, f"{key}_fullfield_stitched_mapped.ome.tif")
+    return outputs
+
+def _input_digests(inputs : list, cache : HashCache = None) -> dict:
+    """
+    content hashes of input files, keyed by path; files with the same size and mtime as in cache are not read again
+    """
+    return {path: hash_file_cached(path, cache) for path in inputs}
+
+def is_session_current(inputs : list, outputs : list, record_path : str, cache : HashCache = None) -> bool:
+    """
+    is_session_current : whether stitching outputs are up to date - all exist and are newer than all inputs, 
+    or the inputs' content hashes are the same as recorded when the outputs were written (e.g. after a copy that changed mtimes)
+
+    Parameters
+    ----------
+    inputs : list
+        paths to input files (raw tiff, surface tiff)
+    outputs : list
+        paths to output files
+    record_path : str
+        json file with input hashes, written by run_batch_stitching
+    cache : HashCache, optional
+        cache of input hashes, inputs that didn't change since they were last hashed are not read, by default None
+
+    Returns
+    -------
+    bool
+        True if the session doesn't need stitching
+    """
+    if not all(os.path.isfile(path) for path in outputs):
+        return False
+    if min(os.path.getmtime(path) for path in outputs) >= max(os.path.getmtime(path) for path in inputs):
+        return True
+    if not os.path.isfile(record_path):
+        return False
+    with open(record_path) as record_file:
+        recorded = json.load(record_file)
+    return recorded == _input_digests(inputs, cache)
+
+def _run_session_stitching(key : str, path_to_tiff : str, surface_path : str, output_dir : str, force : bool) -> dict:
+    """
+    Worker: stitch one session unless its outputs are current, record input hashes
+    """
+    start = time.time()
+    inputs = [path for path in [path_to_tiff, surface_path] if path is not None]
+    outputs = get_session_outputs(output_dir, key, surface_path is not None)
+    record_path = os.path.join(output_dir, f"{key}_fullfield_inputs.json")
+    # one cache file per session, so worker processes never write the same file
+    cache = HashCache(os.path.join(output_dir, f"{key}_fullfield_hashes.json"))
+    try:
+        if not force and is_session_current(inputs, list(outputs.values()), record_path, cache):
+            status = 'skipped'
+        else:
+            stitch_session(path_to_tiff, output_dir, key, surface_path)
+            with open(record_path, 'w') as record_file:
+                json.dump(_input_digests(inputs, cache), record_file, indent=1)
+            status = 'stitched'
+    finally:
+        cache.save()
+    return {'key': key, 'raw_path': path_to_tiff, 'surface_path': surface_path, 'status': status, 
+            'runtime_s': time.time() - start, 'error': None}
+
+def find_sessions(sessions : list, lims_api : object = None, surface_pattern : str = '*averaged_surface.tiff') -> dict:
+    """
+    find_sessions : resolve raw full field tiffs and surface files of sessions
+
+    Parameters
+    ----------
+    sessions : list
+        session IDs (resolved with LimsApi.get_fullfield_raw_path) and/or glob patterns of raw full field tiffs
+    lims_api : object, optional
+        LimsApi instance, needed for session IDs, by default None
+    surface_pattern : str, optional
+        glob pattern of the surface tiff in the raw tiff's folder, by default '*averaged_surface.tiff';
+        if there are several, the one starting with the session key is used
+
+    Returns
+    -------
+    dict
+        {key : (raw tiff path or None, surface path or None)}, key is session id or raw file name before "_fullfield"
+    """
+    found = {}
+    for session in sessions:
+        if str(session).isdigit():
+            assert lims_api is not None, "LimsApi instance is needed to find sessions by ID"
+            found[str(session)] = lims_api.get_fullfield_raw_path(int(session))
+        else:
+            for path in sorted(glob.glob(session)):
+                found[os.path.basename(path).split('_fullfield')[0]] = path
+
+    sessions_found = {}
+    for key, path in found.items():
+        surface_path = None
+        if path is not None:
+            surfaces = sorted(glob.glob(os.path.join(os.path.dirname(path), surface_pattern)))
+            # several sessions can share a folder: prefer the surface named after the session, else the only one
+            own_surfaces = [surface for surface in surfaces if os.path.basename(surface).startswith(key)]
+            if own_surfaces:
+                surface_path = own_surfaces[0]
+            elif len(surfaces) == 1:
+                surface_path = surfaces[0]
+        sessions_found[key] = (path, surface_path)
+    return sessions_found
+
+def run_batch_stitching(sessions : dict, output_dir : str, n_workers : int = None, force : bool = False) -> pd.DataFrame:
+    """
+    run_batch_stitching : stitch and map many sessions in a process pool, skipping sessions whose outputs are current
+    (see is_session_current). A summary table is written to output_dir/stitch_summary.csv
+
+    Parameters
+    ----------
+    sessions : dict
+        output of find_sessions
+    output_dir : str
+        folder for outputs, created if it does not exist
+    n_workers : int, optional
+        number of processes, by default number of cores
+    force : bool, optional
+        stitch even if outputs are current, by default False
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per session: key, raw_path, surface_path, status (stitched, skipped, failed), runtime_s, error
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    summary = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {}
+        for key, (path_to_tiff, surface_path) in sessions.items():
+            if path_to_tiff is None:
+                summary.append({'key': key, 'raw_path': None, 'surface_path': None, 'status': 'failed', 
+                                'runtime_s': 0.0, 'error': 'raw full field tiff not found'})
+            else:
+                future = executor.submit(_run_session_stitching, key, path_to_tiff, surface_path, output_dir, force)
+                futures[future] = (key, path_to_tiff, surface_path)
+        for future in as_completed(futures):
+            key, path_to_tiff, surface_path = futures[future]
+            try:
+                summary.append(future.result())
+            except Exception as error:
+                print(f"Stitching failed for {key}: {error}")
+                summary.append({'key': key, 'raw_path': path_to_tiff, 'surface_path': surface_path, 'status': 'failed', 
+                                'runtime_s': None, 'error': repr(error)})
+
+    summary = pd.DataFrame(summary, columns=['key', 'raw_path', 'surface_path', 'status', 'runtime_s', 'error'])
+    summary = summary.sort_values('key', ignore_index=True)
+    summary.to_csv(os.path.join(output_dir, 'stitch_summary.csv'), index=False)
+    return summary
+
+def main(argv : list = None) -> int:
+    """
+    Command line entry point for batch stitching, see --help
+    returns exit status: 1 if any session failed, 0 otherwise
+    """
+    parser = argparse.ArgumentParser(description="Stitch full field stacks and map surface images into them")
+    parser.add_argument('sessions', nargs='+', help="session IDs and/or glob patterns of raw *_fullfield.tiff files")
+    parser.add_argument('-o', '--output-dir', required=True, help="folder for stitched files and stitch_summary.csv")
+    parser.add_argument('--lims-credentials', default=None, help="json file with LIMS credentials, needed for session IDs")
+    parser.add_argument('--surface-pattern', default='*averaged_surface.tiff', help="glob of surface tiff next to the raw tiff")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="number of processes, default: number of cores")
+    parser.add_argument('--force', action='store_true', help="stitch even if outputs are up to date")
+    args = parser.parse_args(argv)
+
+    lims_api = None
+    if args.lims_credentials is not None:
+        from meso_tools.io_utils import LimsApi
+        with open(args.lims_credentials) as credentials_file:
+            lims_api = LimsApi(json.load(credentials_file))
+
+    sessions = find_sessions(args.sessions, lims_api, args.surface_pattern)
+    summary = run_batch_stitching(sessions, args.output_dir, args.workers, args.force)
+    print(summary['status'].value_counts().to_string())
+    return int((summary['status'] == 'failed').any())
+
+if __name__ == "__main__":
+    sys.exit(main())
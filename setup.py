@@ -43,6 +43,7 @@ if __name__ == '__main__':
         ],
         entry_points = {
            #'console_scripts': ['mouse_director=mousedirector:main'] <--- if you want to create exes
+           'console_scripts': ['stitch_full_field=meso_tools.stitch_full_field:main'],
         },
         data_files = [],  # these are non-python files but you almost never want this
         package_data = {},
@@ -56,7 +57,6 @@ if __name__ == '__main__':
             'pandas',
             'psycopg2',
             'glob',
-            'sciris',
             'scikit-image',
             'scipy',
             'allensdk==2.11.3'],
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+from meso_tools.image_tools import align_phase_stack, compute_histogram_stats, estimate_phase_offsets
+
+
+def test_compute_histogram_stats_int32():
+    image = np.random.default_rng(0).integers(-10**6, 10**6, (64, 64)).astype(np.int32)
+    stats = compute_histogram_stats(image)
+    bin_width = (int(image.max()) - int(image.min())) / 65536
+    assert abs(stats['i_max'] - np.percentile(image, 95)) <= bin_width
+    assert abs(stats['i_min'] - np.percentile(image, 5)) <= bin_width
+
+def test_align_phase_stack_subpixel_rejects_inplace_and_integer_out():
+    stack = np.random.default_rng(0).integers(0, 1000, (4, 32, 64)).astype(np.int16)
+    with pytest.raises(ValueError):
+        align_phase_stack(stack, inplace=True, subpixel=True)
+    with pytest.raises(ValueError):
+        align_phase_stack(stack, out=np.empty((4, 32, 63), np.int16), subpixel=True)
+    with pytest.raises(ValueError):
+        align_phase_stack(stack, out=np.empty((4, 32, 62), np.int16), offset=1.5)
+    assert align_phase_stack(stack, inplace=True, offset=1).base is stack
+
+def test_estimate_phase_offsets_non_square():
+    # odd lines are even lines moved by 3 pixels; the zero lag is at the middle of a line (columns), 
+    # not at half the number of rows, so a 40 x 64 frame gives the same offset as a square one
+    line = np.random.default_rng(0).random(84) - 0.5
+    image = np.empty((40, 64))
+    image[0::2] = line[10:74]
+    image[1::2] = line[7:71]
+    assert estimate_phase_offsets(image)[0] == -3
+    assert estimate_phase_offsets(image[:, :40])[0] == -3